@@ -1,8 +1,11 @@
 import psycopg2, psycopg2.extras
 from .settings import settings
 
-def conn():
-    return psycopg2.connect(settings.PG_DSN)
+def conn(connect_timeout: int | None = None):
+    # connect_timeout is in whole seconds; libpq treats anything below 2 as 2
+    if connect_timeout is None:
+        return psycopg2.connect(settings.PG_DSN)
+    return psycopg2.connect(settings.PG_DSN, connect_timeout=connect_timeout)
 
 def ensure_pgvector_extension():
     with conn() as c, c.cursor() as cur:
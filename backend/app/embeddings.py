@@ -22,9 +22,11 @@ def cohere_embed(
     image_bytes: Optional[bytes],
     input_type: Literal["search_document","search_query","classification","clustering"]="search_document",
     output_dimension: Optional[int] = None,
+    model: Optional[str] = None,
 ) -> List[float]:
     """
     Calls Cohere /embed with retries and honors 429 Retry-After.
+    `model` defaults to COHERE_EMBED_MODEL; embedding migrations pass the target model.
     """
     if not settings.COHERE_API_KEY:
         raise RuntimeError("COHERE_API_KEY missing")
@@ -40,7 +42,7 @@ def cohere_embed(
 
     payload = {
         "inputs": [{"content": content}],
-        "model": settings.COHERE_EMBED_MODEL,
+        "model": model or settings.COHERE_EMBED_MODEL,
         "input_type": input_type,
         "embedding_types": ["float"],
     }
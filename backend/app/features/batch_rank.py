@@ -0,0 +1,315 @@
+# app/features/batch_rank.py
+"""
+Rank feeds for many users at once (digest notifications, precompute jobs).
+
+Instead of one /api/rank call per user, the candidate set (recent posts with
+their like counts and ages) is loaded once, and each chunk of users is scored
+with a single [users x posts] matrix multiply. The score uses the same terms
+as rank()'s ORDER BY (weights in ranking.py).
+
+The results are NOT identical to rank()'s:
+  - rank() scores every post of the user's embedding version (its ORDER BY
+    is a compound expression the ivfflat index can't serve, so Postgres
+    scans and sorts them all). Here candidates are capped at the
+    `max_candidates` (default 20k) most recent posts, purely to bound
+    memory: the matrix is held in RAM. An older post that rank() would
+    place in the top-N never appears here. Raise the cap (CLI
+    --max-candidates) if the post table fits.
+  - rank()'s random diversity slots are not applied; callers get the pure top-N
+
+Users are streamed in chunks (memory ~ chunk_size x candidates floats) and
+chunks are scored on a thread pool; NumPy releases the GIL in the matmul.
+The candidate matrix for 20k x 1536-dim posts is ~120MB, so the HTTP
+endpoint shares one TTL-cached copy (`shared_candidate_cache`) across calls
+instead of loading its own. Full-population runs belong in the CLI:
+
+    python -m app.features.batch_rank --all --limit 10 --out feeds.jsonl
+"""
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app.db import conn
+from app.features.embedding_versions import active_spec
+from app.features.ranking import FRESHNESS_CAP, FRESHNESS_PER_HOUR, POPULARITY_ALPHA
+from app.settings import settings
+
+DEFAULT_MAX_CANDIDATES = 20_000
+
+
+# -------------------- CANDIDATES --------------------
+
+class _Candidates:
+    """Normalised post matrix + per-post static score term for one embedding version."""
+
+    def __init__(self, fbids: np.ndarray, P: np.ndarray, bias: np.ndarray, popular: List[str]):
+        self.fbids = fbids      # [c]
+        self.P = P              # [c, d], rows L2-normalised
+        self.bias = bias        # [c], freshness penalty - popularity reward
+        self.popular = popular  # cold-start order: likes desc, newest first
+
+
+def _load_candidates(version: int, max_candidates: int, fetch_size: int = 2000) -> _Candidates:
+    fbids: List[str] = []
+    likes: List[float] = []
+    ages: List[float] = []
+    blocks: List[np.ndarray] = []
+    with conn() as c:
+        with c.cursor(name="batch_rank_candidates") as cur:
+            cur.itersize = fetch_size
+            cur.execute(
+                """
+                WITH post_likes AS (
+                  SELECT post_id, COUNT(*) AS likes
+                  FROM user_events
+                  WHERE etype = 'like'
+                  GROUP BY post_id
+                )
+                SELECT
+                  p.firebase_id,
+                  (p.embedding)::float4[] AS embedding,
+                  COALESCE(pl.likes, 0) AS likes,
+                  EXTRACT(EPOCH FROM (now() - p.created_at)) / 3600.0 AS age_h
+                FROM posts p
+                LEFT JOIN post_likes pl ON pl.post_id = p.id
+                WHERE p.embedding IS NOT NULL
+                  AND p.firebase_id IS NOT NULL
+                  AND p.embedding_version = %s
+                ORDER BY p.created_at DESC
+                LIMIT %s
+                """,
+                (version, max_candidates),
+            )
+            while True:
+                rows = cur.fetchmany(fetch_size)
+                if not rows:
+                    break
+                fbids.extend(r[0] for r in rows)
+                blocks.append(np.array([r[1] for r in rows], dtype=np.float32))
+                likes.extend(float(r[2]) for r in rows)
+                ages.extend(float(r[3] or 0.0) for r in rows)
+
+    if not blocks:
+        return _Candidates(np.empty(0, dtype=object), np.empty((0, 0), dtype=np.float32),
+                           np.empty(0, dtype=np.float32), [])
+
+    P = np.concatenate(blocks, axis=0)
+    norms = np.linalg.norm(P, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    P /= norms
+
+    L = np.array(likes, dtype=np.float32)
+    A = np.array(ages, dtype=np.float32)
+    bias = np.minimum(FRESHNESS_CAP, np.maximum(0.0, A * FRESHNESS_PER_HOUR)) - POPULARITY_ALPHA * np.log1p(L)
+
+    fb = np.array(fbids, dtype=object)
+    popular = fb[np.lexsort((A, -L))].tolist()   # likes desc, then age asc
+    print(f"[batch-rank] loaded candidates version={version} n={len(fb)}")
+    return _Candidates(fb, P, bias.astype(np.float32), popular)
+
+
+# -------------------- USERS --------------------
+
+def _load_user_chunk(uids: List[str]) -> List[Tuple[str, List[float], int]]:
+    with conn() as c, c.cursor() as cur:
+        cur.execute(
+            """
+            SELECT uid, (embedding)::float4[], embedding_version
+            FROM user_embeddings
+            WHERE uid = ANY(%s) AND embedding IS NOT NULL
+            """,
+            (uids,),
+        )
+        return cur.fetchall()
+
+
+def iter_all_uids(batch_size: int = 1000) -> Iterator[str]:
+    """
+    Every uid with a profile, keyset-paginated with a short transaction per
+    page (as profile_rebuild does) so a long run doesn't hold back vacuum.
+    """
+    last_uid = ""
+    while True:
+        with conn() as c, c.cursor() as cur:
+            cur.execute(
+                """
+                SELECT uid FROM user_embeddings
+                WHERE uid > %s AND embedding IS NOT NULL
+                ORDER BY uid
+                LIMIT %s
+                """,
+                (last_uid, batch_size),
+            )
+            uids = [r[0] for r in cur.fetchall()]
+        if not uids:
+            break
+        yield from uids
+        last_uid = uids[-1]
+
+
+# -------------------- SCORING --------------------
+
+def _top_n(U: np.ndarray, cand: _Candidates, n: int) -> np.ndarray:
+    """Indices [u, n] of the n lowest-scoring candidates per user, best first."""
+    norms = np.linalg.norm(U, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    D = 1.0 - (U / norms) @ cand.P.T          # [u, c] cosine distance
+    D += cand.bias[None, :]
+    n = min(n, D.shape[1])
+    if n == D.shape[1]:
+        return np.argsort(D, axis=1)
+    part = np.argpartition(D, n - 1, axis=1)[:, :n]                 # unordered top-n
+    order = np.argsort(np.take_along_axis(D, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+
+class _CandidateCache:
+    """
+    Loads each embedding version's candidate set once, shared by all threads.
+    With `ttl_s` a set older than that is reloaded on next use, so one cache
+    can outlive a single run (see shared_candidate_cache).
+    """
+
+    def __init__(self, max_candidates: int, ttl_s: Optional[float] = None):
+        self.max_candidates = max_candidates
+        self.ttl_s = ttl_s
+        self._by_version: Dict[int, Tuple[float, _Candidates]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, version: int) -> _Candidates:
+        with self._lock:
+            hit = self._by_version.get(version)
+            if hit is None or (self.ttl_s is not None and time.monotonic() - hit[0] > self.ttl_s):
+                # drop the stale copy before loading so the cache never holds both
+                self._by_version.pop(version, None)
+                hit = (time.monotonic(), _load_candidates(version, self.max_candidates))
+                self._by_version[version] = hit
+            return hit[1]
+
+
+_shared_cache: Optional[_CandidateCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def shared_candidate_cache() -> _CandidateCache:
+    """Process-wide candidate cache for the HTTP endpoint, reloaded every BATCH_RANK_CANDIDATES_TTL_S."""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = _CandidateCache(DEFAULT_MAX_CANDIDATES, ttl_s=settings.BATCH_RANK_CANDIDATES_TTL_S)
+        return _shared_cache
+
+
+def _rank_chunk(
+    uids: List[str], limit: int, cache: _CandidateCache, active_version: int
+) -> Dict[str, List[str]]:
+    rows = _load_user_chunk(uids)
+    out: Dict[str, List[str]] = {}
+
+    by_version: Dict[int, List[Tuple[str, List[float]]]] = {}
+    for uid, emb, version in rows:
+        by_version.setdefault(version, []).append((uid, emb))
+
+    # only compare user and post vectors of the same embedding version
+    for version, members in by_version.items():
+        cand = cache.get(version)
+        if len(cand.fbids) == 0:
+            continue
+        U = np.array([emb for _, emb in members], dtype=np.float32)
+        idx = _top_n(U, cand, limit)
+        for (uid, _), row in zip(members, idx):
+            out[uid] = cand.fbids[row].tolist()
+
+    # no profile yet → same popularity fallback rank() uses for cold start
+    missing = [u for u in uids if u not in out]
+    if missing:
+        popular = cache.get(active_version).popular[:limit]
+        for uid in missing:
+            out[uid] = list(popular)
+    return out
+
+
+def _chunks(uids: Iterable[str], size: int) -> Iterator[List[str]]:
+    chunk: List[str] = []
+    for uid in uids:
+        chunk.append(uid)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def rank_users(
+    uids: Iterable[str],
+    limit: int = 15,
+    chunk_size: int = 256,
+    workers: int = 4,
+    max_candidates: int = DEFAULT_MAX_CANDIDATES,
+    cache: Optional[_CandidateCache] = None,
+) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Yield (uid, post_ids) for every uid, in chunk completion order.
+    `uids` may be any iterable (e.g. iter_all_uids()); at most 2 * workers
+    chunks are in flight, so memory stays bounded regardless of its length.
+    Candidates are the `max_candidates` most recent posts (see module doc);
+    pass `cache` to reuse an already loaded set instead of loading one.
+    """
+    if cache is None:
+        cache = _CandidateCache(max_candidates)
+    # cold-start fallback version, fixed for the whole run
+    active_version = active_spec()["version"]
+    t0 = time.time()
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = set()
+
+        def drain(futures):
+            nonlocal done
+            for f in futures:
+                result = f.result()
+                done += len(result)
+                yield from result.items()
+
+        for chunk in _chunks(uids, chunk_size):
+            pending.add(pool.submit(_rank_chunk, chunk, limit, cache, active_version))
+            if len(pending) >= 2 * max(1, workers):
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from drain(finished)
+                print(f"[batch-rank] users={done} elapsed={time.time() - t0:.1f}s")
+        yield from drain(pending)
+    print(f"[batch-rank] done users={done} elapsed={time.time() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Rank feeds for many users into a JSON lines file")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("--all", action="store_true", help="every user with a profile")
+    src.add_argument("--uids-file", help="file with one uid per line")
+    ap.add_argument("--out", required=True, help="output .jsonl path")
+    ap.add_argument("--limit", type=int, default=15)
+    ap.add_argument("--chunk-size", type=int, default=256)
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--max-candidates", type=int, default=DEFAULT_MAX_CANDIDATES)
+    args = ap.parse_args()
+
+    if args.all:
+        source = iter_all_uids()
+    else:
+        with open(args.uids_file) as f:
+            source = [line.strip() for line in f if line.strip()]
+
+    with open(args.out, "w") as out:
+        for uid, post_ids in rank_users(
+            source,
+            limit=args.limit,
+            chunk_size=args.chunk_size,
+            workers=args.workers,
+            max_candidates=args.max_candidates,
+        ):
+            out.write(json.dumps({"uid": uid, "post_ids": post_ids}) + "\n")
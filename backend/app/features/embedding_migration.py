@@ -0,0 +1,509 @@
+# app/features/embedding_migration.py
+"""
+Online migration of post/user embeddings to a new Cohere model or dimension.
+
+Lifecycle (one migration at a time, tracked in embedding_versions):
+
+  start    register a 'shadow' version and add the embedding_next columns
+  backfill re-embed posts into embedding_next at EMBED_MIGRATION_QPS
+           (_compute_and_save_embedding dual-writes new posts meanwhile)
+  index    build the ivfflat index on embedding_next CONCURRENTLY
+  cutover  sweep stragglers into embedding_next, rebuild shadow user
+           profiles and the next post_neighbors graph, then swap the column
+           sets and the graph in one transaction once coverage >=
+           EMBED_MIGRATION_CUTOVER_COVERAGE; afterwards repair any post the
+           swap left without a served vector or neighbour row
+  retire   drop the *_prev columns left behind by the cutover
+  repair   embed posts whose active embedding is missing or stale
+  abort    drop the embedding_next columns and retire the shadow version
+
+Until cutover, rank() keeps serving from the `embedding` columns, and it only
+compares user and post vectors carrying the same embedding_version.
+
+Only title + body are re-embedded: images are not stored in Postgres, so
+image signal from the original upload is lost for backfilled posts, and
+image-only posts (no text at all) cannot be backfilled. They are left out of
+the coverage ratio, reported as `image_only_missing`, and DROPPED from serving
+at cutover (their old vector stays in embedding_prev until `retire`) unless
+they were dual-written with their image while the migration ran.
+
+    python -m app.features.embedding_migration start --model embed-v4.0 --dim 1024
+    python -m app.features.embedding_migration run
+    python -m app.features.embedding_migration status
+"""
+import argparse
+import time
+from typing import Optional
+
+import psycopg2
+import psycopg2.extras
+
+from app.db import conn
+from app.embeddings import cohere_embed
+from app.settings import settings
+from app.features.embedding_versions import EMBEDDING_COLUMNS, active_spec, shadow_spec
+from app.features.profile_rebuild import rebuild_all_user_embeddings
+from app.features.related import (
+    STAGING_NEIGHBORS_TABLE,
+    build_all_post_neighbors,
+    create_staging_graph,
+    drop_staging_graph,
+    swap_in_staging_graph,
+    update_post_neighbors,
+)
+
+_SHADOW_INDEX = "posts_embedding_next_idx"
+_ACTIVE_INDEX = "posts_embedding_idx"
+
+# posts with something cohere_embed can embed without the original image
+_HAS_TEXT = r"(COALESCE(title, '') || COALESCE(body, '')) ~ '\S'"
+
+
+# -------------------- STATE --------------------
+
+def _has_column(table: str, column: str) -> bool:
+    with conn() as c, c.cursor() as cur:
+        cur.execute(
+            """
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = %s AND column_name = %s
+            """,
+            (table, column),
+        )
+        return cur.fetchone() is not None
+
+
+def coverage() -> dict:
+    """
+    Share of embedded posts that already have a shadow vector. Image-only
+    posts that lack one can never get it from backfill, so they are counted
+    separately (`image_only_missing`) instead of against the ratio.
+    """
+    shadow = shadow_spec()
+    if not shadow:
+        return {"shadow": None, "covered": 0, "total": 0, "coverage": 0.0, "image_only_missing": 0}
+    with conn() as c, c.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT
+              COUNT(*) FILTER (WHERE covered),
+              COUNT(*) FILTER (WHERE covered OR {_HAS_TEXT}),
+              COUNT(*) FILTER (WHERE NOT covered AND NOT {_HAS_TEXT})
+            FROM (
+              SELECT title, body,
+                     COALESCE(embedding_next IS NOT NULL AND embedding_next_version = %s, false) AS covered
+              FROM posts
+              WHERE embedding IS NOT NULL OR embedding_next IS NOT NULL
+            ) p
+            """,
+            (shadow["version"],),
+        )
+        covered, total, image_only = cur.fetchone()
+    ratio = covered / total if total else 1.0
+    return {
+        "shadow": shadow,
+        "covered": covered,
+        "total": total,
+        "coverage": ratio,
+        "image_only_missing": image_only,
+    }
+
+
+def status() -> dict:
+    cov = coverage()
+    return {
+        "active": active_spec(),
+        "shadow": cov["shadow"],
+        "covered": cov["covered"],
+        "total": cov["total"],
+        "coverage": round(cov["coverage"], 4),
+        "image_only_missing": cov["image_only_missing"],
+        "shadow_index": _index_is_valid(_SHADOW_INDEX),
+        "prev_columns": _has_column("posts", "embedding_prev"),
+    }
+
+
+# -------------------- START --------------------
+
+def _vector_dim(table: str, column: str) -> Optional[int]:
+    """Declared dimension of a vector(n) column (pgvector stores n as the typmod), or None."""
+    with conn() as c, c.cursor() as cur:
+        cur.execute(
+            """
+            SELECT atttypmod FROM pg_attribute
+            WHERE attrelid = %s::regclass AND attname = %s AND NOT attisdropped
+            """,
+            (table, column),
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def start(model: str, dim: int) -> dict:
+    if shadow_spec():
+        raise RuntimeError("a migration is already in progress")
+    if _has_column("posts", "embedding_prev"):
+        raise RuntimeError("previous migration not retired yet (run `retire` first)")
+    # ADD COLUMN IF NOT EXISTS would silently keep a leftover column's dimension
+    for table in ("posts", "user_embeddings"):
+        existing = _vector_dim(table, "embedding_next")
+        if existing is not None and existing != dim:
+            raise RuntimeError(
+                f"{table}.embedding_next already exists as vector({existing}), not vector({dim}) "
+                "(run `abort` first)"
+            )
+
+    with conn() as c, c.cursor() as cur:
+        cur.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM embedding_versions")
+        version = cur.fetchone()[0]
+        cur.execute(
+            "INSERT INTO embedding_versions(version, model, dim, state) VALUES (%s, %s, %s, 'shadow')",
+            (version, model, dim),
+        )
+        # ADD COLUMN without a default is a catalog-only change; no table rewrite
+        for table in ("posts", "user_embeddings"):
+            cur.execute(
+                f"""
+                ALTER TABLE {table}
+                  ADD COLUMN IF NOT EXISTS embedding_next vector({int(dim)}),
+                  ADD COLUMN IF NOT EXISTS embedding_next_model TEXT,
+                  ADD COLUMN IF NOT EXISTS embedding_next_version INT
+                """
+            )
+    print(f"[migrate] started version={version} model={model} dim={dim}")
+    return {"version": version, "model": model, "dim": dim}
+
+
+# -------------------- BACKFILL --------------------
+
+def backfill(column: str = "embedding_next", batch: int = 200, qps: Optional[float] = None) -> int:
+    """
+    Embed every post missing a vector in `column`, in id order, at a capped QPS.
+    Keyset pagination means each post is tried once per call, so posts whose
+    text can't be embedded don't stall the loop. Image-only posts are skipped
+    (no image to re-embed; see the module docstring). Returns the number saved.
+    """
+    if column not in EMBEDDING_COLUMNS:
+        raise ValueError(f"unknown embedding column {column!r}")
+    spec = active_spec() if column == "embedding" else shadow_spec()
+    if spec is None:
+        raise RuntimeError("no embedding migration in progress")
+    emb_col, model_col, ver_col = EMBEDDING_COLUMNS[column]
+
+    min_interval = 1.0 / max(0.1, qps or settings.EMBED_MIGRATION_QPS)
+    last_call = 0.0
+    last_id = 0
+    saved = 0
+    failed = 0
+    print(f"[migrate] backfill column={column} version={spec['version']} qps={1.0 / min_interval:.1f}")
+
+    while True:
+        with conn() as c, c.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                f"""
+                SELECT id, COALESCE(title, '') AS title, COALESCE(body, '') AS body
+                FROM posts
+                WHERE id > %s
+                  AND ({emb_col} IS NULL OR {ver_col} IS DISTINCT FROM %s)
+                  AND {_HAS_TEXT}
+                ORDER BY id
+                LIMIT %s
+                """,
+                (last_id, spec["version"], batch),
+            )
+            rows = cur.fetchall()
+        if not rows:
+            break
+
+        for row in rows:
+            last_id = row["id"]
+            full_text = (row["title"] + " " + row["body"]).strip()
+            now = time.time()
+            if now - last_call < min_interval:
+                time.sleep(min_interval - (now - last_call))
+            try:
+                e = cohere_embed(
+                    full_text,
+                    None,
+                    input_type="search_document",
+                    output_dimension=spec["dim"],
+                    model=spec["model"],
+                )
+            except (RuntimeError, ValueError) as ex:
+                failed += 1
+                print(f"[migrate] embed failed post_id={row['id']}: {ex}")
+                continue
+            finally:
+                last_call = time.time()
+
+            try:
+                with conn() as c, c.cursor() as cur:
+                    cur.execute(
+                        f"""
+                        UPDATE posts
+                        SET {emb_col} = (%s)::float4[]::vector,
+                            {model_col} = %s,
+                            {ver_col} = %s
+                        WHERE id = %s
+                        """,
+                        (e, spec["model"], spec["version"], row["id"]),
+                    )
+            except psycopg2.Error as ex:
+                failed += 1
+                print(f"[migrate] save failed post_id={row['id']}: {ex}")
+                continue
+            saved += 1
+
+            # repair writes served vectors, so the related-posts graph must follow
+            if column == "embedding":
+                try:
+                    update_post_neighbors(row["id"])
+                except psycopg2.Error as ex:
+                    print(f"[related] neighbour update failed post_id={row['id']}: {ex}")
+
+        print(f"[migrate] backfill last_id={last_id} saved={saved} failed={failed}")
+
+    print(f"[migrate] backfill done saved={saved} failed={failed}")
+    return saved
+
+
+# -------------------- INDEX --------------------
+
+def _index_is_valid(name: str) -> bool:
+    with conn() as c, c.cursor() as cur:
+        cur.execute(
+            """
+            SELECT i.indisvalid
+            FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+            WHERE c.relname = %s
+            """,
+            (name,),
+        )
+        row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def build_index(lists: int = 100):
+    """
+    CREATE INDEX CONCURRENTLY so posts stays writable while the index builds.
+    A failed concurrent build leaves an INVALID index behind; drop and retry.
+    """
+    if not shadow_spec():
+        raise RuntimeError("no embedding migration in progress")
+    if _index_is_valid(_SHADOW_INDEX):
+        print(f"[migrate] index {_SHADOW_INDEX} already built")
+        return
+
+    c = conn()
+    try:
+        c.autocommit = True  # CONCURRENTLY can't run inside a transaction block
+        with c.cursor() as cur:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {_SHADOW_INDEX}")
+            print(f"[migrate] building {_SHADOW_INDEX} lists={lists}")
+            cur.execute(
+                f"""
+                CREATE INDEX CONCURRENTLY {_SHADOW_INDEX}
+                  ON posts USING ivfflat (embedding_next vector_cosine_ops) WITH (lists = %s)
+                """,
+                (lists,),
+            )
+    finally:
+        c.close()
+    print(f"[migrate] index {_SHADOW_INDEX} built")
+
+
+# -------------------- CUTOVER --------------------
+
+def _swap_columns(cur, table: str):
+    for suffix in ("", "_model", "_version"):
+        cur.execute(f"ALTER TABLE {table} RENAME COLUMN embedding{suffix} TO embedding_prev{suffix}")
+        cur.execute(f"ALTER TABLE {table} RENAME COLUMN embedding_next{suffix} TO embedding{suffix}")
+
+
+def cutover(
+    min_coverage: Optional[float] = None,
+    rebuild_users: bool = True,
+    workers: int = 1,
+    qps: Optional[float] = None,
+) -> dict:
+    """
+    Swap embedding_next -> embedding on posts and user_embeddings atomically.
+    Renames are catalog-only, so the ACCESS EXCLUSIVE lock is held for
+    milliseconds; lock_timeout keeps us from queueing behind long readers.
+
+    Any post still without a shadow vector would come out of the swap with
+    embedding = NULL and vanish from ranking, related posts and profiles, so
+    stragglers are swept into embedding_next first, and a repair pass over
+    `embedding` afterwards catches whatever slipped in between. Image-only
+    posts can't be swept and are dropped from serving (logged with a count).
+    """
+    threshold = settings.EMBED_MIGRATION_CUTOVER_COVERAGE if min_coverage is None else min_coverage
+    cov = coverage()
+    shadow = cov["shadow"]
+    if not shadow:
+        raise RuntimeError("no embedding migration in progress")
+    if cov["coverage"] < threshold:
+        raise RuntimeError(f"coverage {cov['coverage']:.4f} below cutover threshold {threshold:.4f}")
+    if not _index_is_valid(_SHADOW_INDEX):
+        raise RuntimeError(f"index {_SHADOW_INDEX} missing or invalid (run `index` first)")
+
+    backfill(column="embedding_next", qps=qps)
+    cov = coverage()
+
+    # next "more like this" graph, resumable if a previous cutover died here
+    create_staging_graph()
+    build_all_post_neighbors(column="embedding_next", table=STAGING_NEIGHBORS_TABLE, missing_only=True)
+
+    # shadow profiles last, so they include events up to the moment of the swap
+    if rebuild_users:
+        rebuild_all_user_embeddings(column="embedding_next", workers=workers)
+
+    with conn() as c, c.cursor() as cur:
+        cur.execute("SET LOCAL lock_timeout = '5s'")
+        _swap_columns(cur, "posts")
+        _swap_columns(cur, "user_embeddings")
+        cur.execute(f"ALTER INDEX IF EXISTS {_ACTIVE_INDEX} RENAME TO posts_embedding_prev_idx")
+        cur.execute(f"ALTER INDEX {_SHADOW_INDEX} RENAME TO {_ACTIVE_INDEX}")
+        swap_in_staging_graph(cur)
+        cur.execute("UPDATE embedding_versions SET state = 'retired' WHERE state = 'active'")
+        cur.execute(
+            "UPDATE embedding_versions SET state = 'active', activated_at = now() WHERE version = %s",
+            (shadow["version"],),
+        )
+    print(f"[migrate] cutover done version={shadow['version']} coverage={cov['coverage']:.4f}")
+    if cov["image_only_missing"]:
+        print(f"[migrate] WARNING {cov['image_only_missing']} image-only posts dropped from serving "
+              "(no text to re-embed; old vectors kept in embedding_prev until retire)")
+
+    # posts created or failed between the sweep and the swap, and posts
+    # dual-written after the staging graph was built
+    backfill(column="embedding", qps=qps)
+    build_all_post_neighbors(missing_only=True)
+    return {
+        "version": shadow["version"],
+        "coverage": cov["coverage"],
+        "image_only_dropped": cov["image_only_missing"],
+    }
+
+
+# -------------------- RETIRE --------------------
+
+def retire():
+    """
+    Drop the previous version's columns. mv_recent_posts still references the
+    old embedding column, so it is recreated on the new one.
+    """
+    if not _has_column("posts", "embedding_prev"):
+        print("[migrate] nothing to retire")
+        return
+    with conn() as c, c.cursor() as cur:
+        cur.execute("DROP MATERIALIZED VIEW IF EXISTS mv_recent_posts")
+        for table in ("posts", "user_embeddings"):
+            cur.execute(
+                f"""
+                ALTER TABLE {table}
+                  DROP COLUMN embedding_prev,
+                  DROP COLUMN embedding_prev_model,
+                  DROP COLUMN embedding_prev_version
+                """
+            )
+        cur.execute(
+            """
+            CREATE MATERIALIZED VIEW mv_recent_posts AS
+            SELECT id, title, body, created_at, embedding
+            FROM posts
+            WHERE embedding IS NOT NULL
+            ORDER BY created_at DESC
+            LIMIT 5000
+            """
+        )
+        cur.execute(
+            """
+            CREATE INDEX mv_recent_posts_embed_idx
+              ON mv_recent_posts USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100)
+            """
+        )
+    print("[migrate] retired previous embedding columns")
+
+
+# -------------------- ABORT --------------------
+
+def abort():
+    """
+    Cancel an in-progress migration: drop the embedding_next columns (their
+    index goes with them) and any staged neighbour graph, and mark the shadow
+    version retired, which also stops the dual-write in
+    _compute_and_save_embedding.
+    """
+    shadow = shadow_spec()
+    with conn() as c, c.cursor() as cur:
+        cur.execute("SET LOCAL lock_timeout = '5s'")
+        for table in ("posts", "user_embeddings"):
+            cur.execute(
+                f"""
+                ALTER TABLE {table}
+                  DROP COLUMN IF EXISTS embedding_next,
+                  DROP COLUMN IF EXISTS embedding_next_model,
+                  DROP COLUMN IF EXISTS embedding_next_version
+                """
+            )
+        cur.execute("UPDATE embedding_versions SET state = 'retired' WHERE state = 'shadow'")
+    drop_staging_graph()
+    print(f"[migrate] aborted version={shadow['version'] if shadow else None}")
+
+
+# -------------------- DRIVER --------------------
+
+def run(workers: int = 1, qps: Optional[float] = None) -> dict:
+    """backfill -> index -> cutover if coverage allows; safe to re-run."""
+    backfill(qps=qps)
+    build_index()
+    cov = coverage()
+    threshold = settings.EMBED_MIGRATION_CUTOVER_COVERAGE
+    if cov["coverage"] < threshold:
+        print(f"[migrate] coverage {cov['coverage']:.4f} < {threshold:.4f}, serving stays on old version")
+        return status()
+    cutover(workers=workers, qps=qps)
+    return status()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Online embedding model migration")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p_start = sub.add_parser("start")
+    p_start.add_argument("--model", required=True)
+    p_start.add_argument("--dim", type=int, required=True)
+    p_run = sub.add_parser("run")
+    p_run.add_argument("--workers", type=int, default=1)
+    p_run.add_argument("--qps", type=float, default=None)
+    p_backfill = sub.add_parser("backfill")
+    p_backfill.add_argument("--qps", type=float, default=None)
+    sub.add_parser("index")
+    p_cut = sub.add_parser("cutover")
+    p_cut.add_argument("--min-coverage", type=float, default=None)
+    p_cut.add_argument("--workers", type=int, default=1)
+    p_cut.add_argument("--qps", type=float, default=None)
+    sub.add_parser("retire")
+    p_repair = sub.add_parser("repair")
+    p_repair.add_argument("--qps", type=float, default=None)
+    sub.add_parser("abort")
+    sub.add_parser("status")
+    args = ap.parse_args()
+
+    if args.cmd == "start":
+        start(args.model, args.dim)
+    elif args.cmd == "run":
+        run(workers=args.workers, qps=args.qps)
+    elif args.cmd == "backfill":
+        backfill(qps=args.qps)
+    elif args.cmd == "index":
+        build_index()
+    elif args.cmd == "cutover":
+        cutover(min_coverage=args.min_coverage, workers=args.workers, qps=args.qps)
+    elif args.cmd == "retire":
+        retire()
+    elif args.cmd == "repair":
+        backfill(column="embedding", qps=args.qps)
+    elif args.cmd == "abort":
+        abort()
+    print(status())
@@ -0,0 +1,69 @@
+# app/features/embedding_versions.py
+from typing import Optional
+
+import psycopg2.errors
+import psycopg2.extras
+
+from app.db import conn
+from app.settings import settings
+
+# Column triplets that hold one embedding version on posts / user_embeddings.
+# "embedding" is what ranking serves from; "embedding_next" is the shadow copy
+# that exists only while a model migration is in progress.
+EMBEDDING_COLUMNS = {
+    "embedding":      ("embedding", "embedding_model", "embedding_version"),
+    "embedding_next": ("embedding_next", "embedding_next_model", "embedding_next_version"),
+}
+
+
+def _spec_for_state(state: str) -> Optional[dict]:
+    """
+    Row for `state`, or None. A database that predates
+    migrations/003_embedding_versions.sql has no registry at all; treat that
+    like an empty one instead of failing every embed/profile call.
+    """
+    try:
+        with conn() as c, c.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                "SELECT version, model, dim FROM embedding_versions WHERE state = %s",
+                (state,),
+            )
+            row = cur.fetchone()
+    except psycopg2.errors.UndefinedTable:
+        return None
+    return dict(row, registered=True) if row else None
+
+
+def active_spec() -> dict:
+    """
+    Model/dim/version currently stored in the `embedding` columns.
+    Falls back to the env settings (version 1) when embedding_versions is
+    empty or missing; `registered` tells callers which case they got.
+    """
+    spec = _spec_for_state("active")
+    if spec:
+        return spec
+    return {
+        "version": 1,
+        "model": settings.COHERE_EMBED_MODEL,
+        "dim": settings.COHERE_EMBED_DIM,
+        "registered": False,
+    }
+
+
+def shadow_spec() -> Optional[dict]:
+    """Target of an in-progress migration (stored in `embedding_next`), or None."""
+    return _spec_for_state("shadow")
+
+
+def warn_if_settings_differ():
+    """Startup check: once the registry exists, COHERE_EMBED_MODEL/DIM no longer apply."""
+    spec = active_spec()
+    if not spec["registered"]:
+        return
+    if (spec["model"], spec["dim"]) != (settings.COHERE_EMBED_MODEL, settings.COHERE_EMBED_DIM):
+        print(
+            f"[startup] WARNING COHERE_EMBED_MODEL/COHERE_EMBED_DIM={settings.COHERE_EMBED_MODEL}/"
+            f"{settings.COHERE_EMBED_DIM} ignored: embedding_versions says version {spec['version']} "
+            f"is {spec['model']}/{spec['dim']} (use app.features.embedding_migration to change it)"
+        )
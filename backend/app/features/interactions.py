@@ -5,15 +5,22 @@ import psycopg2.extras
 import numpy as np
 
 from app.db import conn
+from app.features.embedding_versions import active_spec
 
 # -------------------- FETCH RECENT EVENT VECTORS --------------------
 
-def _fetch_recent_event_vectors(uid: str, k: int = 30) -> Tuple[List[List[float]], List[float]]:
+def _fetch_recent_event_vectors(
+    uid: str, k: int = 30, version: int | None = None
+) -> Tuple[List[List[float]], List[float]]:
     """
     Fetch the k most recent (weight, embedding) pairs for a user.
+    Only posts embedded with `version` (default: the active one) are used, so a
+    profile never mixes vectors from different models.
     IMPORTANT: cast pgvector -> float4[] so psycopg2 returns a Python list of floats
     instead of a string like "[0.123, ...]".
     """
+    if version is None:
+        version = active_spec()["version"]
     with conn() as c, c.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
         cur.execute(
             """
@@ -24,10 +31,11 @@ def _fetch_recent_event_vectors(uid: str, k: int = 30) -> Tuple[List[List[float]
             JOIN posts p ON p.id = ue.post_id
             WHERE ue.uid = %s
               AND p.embedding IS NOT NULL
+              AND p.embedding_version = %s
             ORDER BY ue.ts DESC
             LIMIT %s
             """,
-            (uid, k),
+            (uid, version, k),
         )
         rows = cur.fetchall()
 
@@ -66,15 +74,19 @@ def _resolve_post_id(firebase_post_id: str | None, post_id: int | None) -> int:
         print(f"[event] resolved firebase_post_id={firebase_post_id} -> id={row[0]}")
         return row[0]
 
+EVENT_WEIGHTS = {
+    "view": 1.0,
+    "like": 3.0,
+    "comment": 5.0,
+    "share": 6.0,
+}
+DEFAULT_EVENT_WEIGHT = 1.0
+
+
 def _event_weight(etype: str, override: float | None) -> float:
     if override is not None:
         return float(override)
-    return {
-        "view": 1.0,
-        "like": 3.0,
-        "comment": 5.0,
-        "share": 6.0,
-    }.get(etype, 1.0)
+    return EVENT_WEIGHTS.get(etype, DEFAULT_EVENT_WEIGHT)
 
 
 # -------------------- PROFILE VECTOR --------------------
@@ -106,7 +118,8 @@ def _maybe_recompute_user_embedding(uid: str, k: int = 30, stride: int = 5):
         print(f"[profile] skip recompute uid={uid} count={n} stride={stride}")
         return
 
-    vecs, ws = _fetch_recent_event_vectors(uid, k=k)
+    spec = active_spec()
+    vecs, ws = _fetch_recent_event_vectors(uid, k=k, version=spec["version"])
     profile = _compute_weighted_profile(vecs, ws)
     if profile is None:
         print(f"[profile] no eligible vectors to recompute uid={uid}")
@@ -115,34 +128,39 @@ def _maybe_recompute_user_embedding(uid: str, k: int = 30, stride: int = 5):
     with conn() as c, c.cursor() as cur:
         cur.execute(
             """
-            INSERT INTO user_embeddings(uid, embedding, examples_count, updated_at)
-            VALUES (%s, (%s)::float4[]::vector, %s, now())
+            INSERT INTO user_embeddings(uid, embedding, embedding_model, embedding_version, examples_count, updated_at)
+            VALUES (%s, (%s)::float4[]::vector, %s, %s, %s, now())
             ON CONFLICT (uid) DO UPDATE
             SET embedding = EXCLUDED.embedding,
+                embedding_model = EXCLUDED.embedding_model,
+                embedding_version = EXCLUDED.embedding_version,
                 examples_count = EXCLUDED.examples_count,
                 updated_at = now()
             """,
-            (uid, profile, len(vecs)),
+            (uid, profile, spec["model"], spec["version"], len(vecs)),
         )
     print(f"[profile] upserted user_embeddings uid={uid} examples_count={len(vecs)}")
 
 def upsert_user_embedding(uid: str, k: int = 30) -> dict:
     _ensure_user(uid)
-    vecs, ws = _fetch_recent_event_vectors(uid, k=k)
+    spec = active_spec()
+    vecs, ws = _fetch_recent_event_vectors(uid, k=k, version=spec["version"])
     profile = _compute_weighted_profile(vecs, ws)
     if profile is None:
         raise HTTPException(status_code=404, detail="no eligible events to compute embedding")
     with conn() as c, c.cursor() as cur:
         cur.execute(
             """
-            INSERT INTO user_embeddings(uid, embedding, examples_count, updated_at)
-            VALUES (%s, (%s)::float4[]::vector, %s, now())
+            INSERT INTO user_embeddings(uid, embedding, embedding_model, embedding_version, examples_count, updated_at)
+            VALUES (%s, (%s)::float4[]::vector, %s, %s, %s, now())
             ON CONFLICT (uid) DO UPDATE
             SET embedding = EXCLUDED.embedding,
+                embedding_model = EXCLUDED.embedding_model,
+                embedding_version = EXCLUDED.embedding_version,
                 examples_count = EXCLUDED.examples_count,
                 updated_at = now()
             """,
-            (uid, profile, len(vecs)),
+            (uid, profile, spec["model"], spec["version"], len(vecs)),
         )
     print(f"[profile] force recompute done uid={uid} examples_count={len(vecs)}")
     return {"uid": uid, "examples_count": len(vecs)}
@@ -1,6 +1,8 @@
 from app.db import conn
 from app.embeddings import cohere_embed
 from app.settings import settings
+from app.features.embedding_versions import active_spec, shadow_spec
+from app.features.related import update_post_neighbors
 import psycopg2.extras
 import time
 import base64
@@ -29,25 +31,80 @@ def _compute_and_save_embedding(
     full_text = (row["title"] + " " + row["body"]).strip()
     print(f"[embed] text_preview='{full_text[:80]}' image={'yes' if img_bytes else 'no'}")
 
-    e = cohere_embed(
-        full_text,
-        img_bytes,
-        input_type="search_document",
-        output_dimension=settings.COHERE_EMBED_DIM,
-    )
-    print(f"[embed] embedding_len={len(e)}")
-
-    with conn() as c, c.cursor() as cur:
-        cur.execute(
-            """
-            UPDATE posts
-            SET
-              embedding         = (%s)::float4[]::vector,
-              embedding_model   = %s,
-              embedding_version = %s
-            WHERE id = %s
-            """,
-            (e, settings.COHERE_EMBED_MODEL, 1, post_id),
+    # the active version can flip mid-job (migration cutover); the UPDATE only
+    # lands if the version we embedded with is still active, otherwise redo once
+    for _ in range(2):
+        spec = active_spec()
+        e = cohere_embed(
+            full_text,
+            img_bytes,
+            input_type="search_document",
+            output_dimension=spec["dim"],
+            model=spec["model"],
         )
+        print(f"[embed] embedding_len={len(e)} version={spec['version']}")
+
+        # without a version registry (003 not applied) there is nothing to race against
+        still_active = """
+                  AND EXISTS (
+                    SELECT 1 FROM embedding_versions
+                    WHERE version = %s AND state = 'active'
+                  )""" if spec["registered"] else ""
+        params = (e, spec["model"], spec["version"], post_id)
+        with conn() as c, c.cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE posts
+                SET
+                  embedding         = (%s)::float4[]::vector,
+                  embedding_model   = %s,
+                  embedding_version = %s
+                WHERE id = %s{still_active}
+                """,
+                params + ((spec["version"],) if spec["registered"] else ()),
+            )
+            saved = cur.rowcount > 0
+        if saved:
+            break
+        print(f"[embed] version {spec['version']} no longer active, re-embedding post_id={post_id}")
+
+    if not saved:
+        # two cutovers inside one job; the next repair pass will embed it
+        print(f"[embed] FAILED post_id={post_id}: active version kept changing, not saved")
+    else:
+        try:
+            update_post_neighbors(post_id)
+        except psycopg2.Error as ex:
+            # the graph is best-effort; a bulk rebuild will pick this post up
+            print(f"[related] neighbour update failed post_id={post_id}: {ex}")
+
+    # dual-write while a migration is running so new posts never need backfill
+    shadow = shadow_spec()
+    if shadow:
+        try:
+            e_next = cohere_embed(
+                full_text,
+                img_bytes,
+                input_type="search_document",
+                output_dimension=shadow["dim"],
+                model=shadow["model"],
+            )
+            with conn() as c, c.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE posts
+                    SET
+                      embedding_next         = (%s)::float4[]::vector,
+                      embedding_next_model   = %s,
+                      embedding_next_version = %s
+                    WHERE id = %s
+                    """,
+                    (e_next, shadow["model"], shadow["version"], post_id),
+                )
+            print(f"[embed] shadow saved post_id={post_id} version={shadow['version']}")
+        except (psycopg2.Error, RuntimeError) as ex:
+            # the shadow may have been cut over or cancelled under us; backfill repairs it
+            print(f"[embed] shadow write skipped post_id={post_id}: {ex}")
 
-    print(f"[embed] saved post_id={post_id}")
+    if saved:
+        print(f"[embed] saved post_id={post_id} version={spec['version']}")
@@ -0,0 +1,339 @@
+# app/features/profile_rebuild.py
+"""
+Bulk rebuild of every user profile vector in user_embeddings.
+
+Same math as `_compute_weighted_profile` (k most recent events, row-normalised
+post vectors, weighted sum, L2-normalised), but done for many users at once:
+
+  - uids are read from `users` in keyset-paginated batches (a short
+    transaction each, so vacuum is never held back for the whole job)
+  - each batch fetches its events joined to post vectors in one query,
+    a LIMIT k lateral per user so only users x k rows are ever read
+  - profiles for the whole batch come from one segmented NumPy reduction
+  - results are written back with a single multi-row upsert per batch
+  - batches are spread across worker processes
+
+Run inside the api container:
+
+    python -m app.features.profile_rebuild --workers 4
+    python -m app.features.profile_rebuild --reweight   # re-apply EVENT_WEIGHTS
+
+--reweight first rewrites user_events.weight from the current EVENT_WEIGHTS
+(in batches), then rebuilds from the stored weights, so the online
+recompute path (_fetch_recent_event_vectors reads ue.weight) agrees with the
+rebuilt profiles afterwards. Events with a weight_override (the `weight` the
+caller sent to /api/user-event) keep it; events recorded before
+migrations/005_event_weight_override.sql have no override on record and are
+reset to the etype default.
+
+`column="embedding_next"` rebuilds the shadow profiles of an in-progress
+model migration (see embedding_migration.py) from the shadow post vectors.
+"""
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import psycopg2.extras
+
+from app.db import conn
+from app.features.embedding_versions import EMBEDDING_COLUMNS, active_spec, shadow_spec
+from app.features.interactions import DEFAULT_EVENT_WEIGHT, EVENT_WEIGHTS
+
+# -------------------- FETCH --------------------
+
+def _iter_uid_batches(batch_size: int) -> Iterator[List[str]]:
+    """
+    Page through `users` (the PK index, not a DISTINCT over user_events),
+    `batch_size` uids at a time. Keyset pagination with one short transaction
+    per page, like embedding_migration.backfill: a cursor held open for the
+    whole job would pin the xmin horizon for hours. Users without eligible
+    events simply yield no rows.
+    """
+    last_uid = ""
+    while True:
+        with conn() as c, c.cursor() as cur:
+            cur.execute(
+                "SELECT uid FROM users WHERE uid > %s ORDER BY uid LIMIT %s",
+                (last_uid, batch_size),
+            )
+            uids = [r[0] for r in cur.fetchall()]
+        if not uids:
+            break
+        yield uids
+        last_uid = uids[-1]
+
+
+def _fetch_batch_events(
+    uids: List[str], k: int, column: str, version: int, fetch_size: int = 2000
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fetch the k most recent (uid, weight, embedding) rows for every uid
+    in the batch, grouped by uid so each user's rows are contiguous.
+    The per-user LATERAL ... ORDER BY ts DESC LIMIT k walks
+    user_events_uid_ts_idx and stops after k matches, so cost scales with
+    users x k rather than with each user's full history.
+    Only post vectors in `column` tagged with `version` are used.
+    Embeddings are converted to float32 as they stream in, so only
+    `fetch_size` rows ever exist as Python lists.
+    """
+    uid_col: List[str] = []
+    weight_col: List[float] = []
+    blocks: List[np.ndarray] = []
+    emb_col, _, ver_col = EMBEDDING_COLUMNS[column]
+
+    with conn() as c:
+        with c.cursor(name="profile_rebuild_events") as cur:
+            cur.itersize = fetch_size
+            # column names come from EMBEDDING_COLUMNS, never from callers
+            cur.execute(
+                f"""
+                SELECT u.uid, e.weight, e.embedding::float4[] AS embedding
+                FROM unnest(%s::text[]) WITH ORDINALITY AS u(uid, ord)
+                CROSS JOIN LATERAL (
+                  SELECT ue.weight, ue.ts, p.{emb_col} AS embedding
+                  FROM user_events ue
+                  JOIN posts p ON p.id = ue.post_id
+                  WHERE ue.uid = u.uid
+                    AND p.{emb_col} IS NOT NULL
+                    AND p.{ver_col} = %s
+                  ORDER BY ue.ts DESC
+                  LIMIT %s
+                ) e
+                ORDER BY u.ord, e.ts DESC
+                """,
+                (uids, version, k),
+            )
+            while True:
+                rows = cur.fetchmany(fetch_size)
+                if not rows:
+                    break
+                uid_col.extend(r[0] for r in rows)
+                weight_col.extend(float(r[1]) for r in rows)
+                blocks.append(np.array([r[2] for r in rows], dtype=np.float32))
+
+    if not blocks:
+        empty = np.empty(0, dtype=object)
+        return empty, np.empty(0, dtype=np.float32), np.empty((0, 0), dtype=np.float32)
+
+    return (
+        np.array(uid_col, dtype=object),
+        np.array(weight_col, dtype=np.float32),
+        np.concatenate(blocks, axis=0),
+    )
+
+
+# -------------------- PROFILE VECTORS --------------------
+
+def _compute_grouped_profiles(
+    uids: np.ndarray, V: np.ndarray, W: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Vectorised `_compute_weighted_profile` for many users at once.
+    `uids` must be sorted so each user's rows are contiguous.
+    Returns (unique uids, profiles [u, d], examples_count [u]).
+    """
+    starts = np.flatnonzero(np.r_[True, uids[1:] != uids[:-1]])       # [u]
+    counts = np.diff(np.r_[starts, len(uids)])                        # [u]
+
+    norms = np.linalg.norm(V, axis=1, keepdims=True)                  # [n, 1]
+    norms[norms == 0.0] = 1.0
+    Q = np.add.reduceat(W[:, None] * (V / norms), starts, axis=0)     # [u, d]
+    q_norms = np.linalg.norm(Q, axis=1, keepdims=True)                # [u, 1]
+    q_norms[q_norms == 0.0] = 1.0
+    Q /= q_norms
+    return uids[starts], Q, counts
+
+
+# -------------------- REWEIGHT --------------------
+
+def reweight_events(batch: int = 50_000) -> int:
+    """
+    Rewrite user_events.weight from EVENT_WEIGHTS for every event without a
+    weight_override, in id-ordered batches (one short transaction each).
+    Rows already at the right weight are not touched. Returns rows updated.
+    """
+    etypes = list(EVENT_WEIGHTS)
+    weights = [EVENT_WEIGHTS[e] for e in etypes]
+    t0 = time.time()
+    last_id = 0
+    updated = 0
+    while True:
+        with conn() as c, c.cursor() as cur:
+            cur.execute(
+                "SELECT MAX(id) FROM (SELECT id FROM user_events WHERE id > %s ORDER BY id LIMIT %s) b",
+                (last_id, batch),
+            )
+            hi = cur.fetchone()[0]
+            if hi is None:
+                break
+            cur.execute(
+                """
+                UPDATE user_events ue
+                SET weight = n.weight
+                FROM (
+                  SELECT e.id, COALESCE(w.weight, %s) AS weight
+                  FROM user_events e
+                  LEFT JOIN unnest(%s::text[], %s::real[]) AS w(etype, weight) ON w.etype = e.etype
+                  WHERE e.id > %s AND e.id <= %s
+                ) n
+                WHERE ue.id = n.id
+                  AND ue.weight_override IS NULL
+                  AND ue.weight IS DISTINCT FROM n.weight
+                """,
+                (DEFAULT_EVENT_WEIGHT, etypes, weights, last_id, hi),
+            )
+            updated += cur.rowcount
+        last_id = hi
+        print(f"[rebuild] reweight last_id={last_id} updated={updated} elapsed={time.time() - t0:.1f}s")
+    print(f"[rebuild] reweight done updated={updated}")
+    return updated
+
+
+# -------------------- UPSERT --------------------
+
+def _bulk_upsert_profiles(
+    uids: np.ndarray, profiles: np.ndarray, counts: np.ndarray, column: str, model: str, version: int
+):
+    emb_col, model_col, ver_col = EMBEDDING_COLUMNS[column]
+    rows = [
+        (str(uid), profile.tolist(), model, version, int(n))
+        for uid, profile, n in zip(uids, profiles, counts)
+    ]
+    with conn() as c, c.cursor() as cur:
+        # column names come from EMBEDDING_COLUMNS, never from callers
+        psycopg2.extras.execute_values(
+            cur,
+            f"""
+            INSERT INTO user_embeddings(uid, {emb_col}, {model_col}, {ver_col}, examples_count, updated_at)
+            VALUES %s
+            ON CONFLICT (uid) DO UPDATE
+            SET {emb_col} = EXCLUDED.{emb_col},
+                {model_col} = EXCLUDED.{model_col},
+                {ver_col} = EXCLUDED.{ver_col},
+                examples_count = EXCLUDED.examples_count,
+                updated_at = now()
+            """,
+            rows,
+            template="(%s, (%s)::float4[]::vector, %s, %s, %s, now())",
+            page_size=500,
+        )
+
+
+def rebuild_batch(
+    uids: List[str],
+    k: int,
+    column: str,
+    model: str,
+    version: int,
+) -> Tuple[int, int, int]:
+    """
+    Rebuild profiles for one batch of uids.
+    Returns (users_scanned, users_written, events_used).
+    Module-level so it can be shipped to worker processes.
+    """
+    ev_uids, W, V = _fetch_batch_events(uids, k, column, version)
+    if len(ev_uids) == 0:
+        return len(uids), 0, 0
+    out_uids, profiles, counts = _compute_grouped_profiles(ev_uids, V, W)
+    _bulk_upsert_profiles(out_uids, profiles, counts, column, model, version)
+    return len(uids), len(out_uids), int(counts.sum())
+
+
+# -------------------- DRIVER --------------------
+
+def _count_users() -> int:
+    with conn() as c, c.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM users")
+        return int(cur.fetchone()[0])
+
+
+def rebuild_all_user_embeddings(
+    k: int = 30,
+    batch_size: int = 1000,
+    workers: int = 1,
+    reweight: bool = False,
+    column: str = "embedding",
+) -> dict:
+    """
+    Rebuild every user's profile. With workers > 1 batches run in a process
+    pool; at most 2 * workers batches are in flight so memory stays bounded.
+    """
+    if column not in EMBEDDING_COLUMNS:
+        raise ValueError(f"unknown embedding column {column!r}")
+    spec = active_spec() if column == "embedding" else shadow_spec()
+    if spec is None:
+        raise RuntimeError("no embedding migration in progress")
+    job = (k, column, spec["model"], spec["version"])
+    if reweight:
+        reweight_events()
+
+    total = _count_users()
+    print(
+        f"[rebuild] start users={total} k={k} batch_size={batch_size} workers={workers} "
+        f"reweight={reweight} column={column} version={spec['version']}"
+    )
+
+    t0 = time.time()
+    scanned = 0
+    done_users = 0
+    done_events = 0
+    done_batches = 0
+
+    def report(n_scanned: int, n_users: int, n_events: int):
+        nonlocal scanned, done_users, done_events, done_batches
+        scanned += n_scanned
+        done_users += n_users
+        done_events += n_events
+        done_batches += 1
+        elapsed = time.time() - t0
+        rate = scanned / elapsed if elapsed > 0 else 0.0
+        eta = (total - scanned) / rate if rate > 0 else float("inf")
+        pct = 100.0 * scanned / total if total else 100.0
+        print(
+            f"[rebuild] batch={done_batches} scanned={scanned}/{total} ({pct:.1f}%) "
+            f"written={done_users} events={done_events} rate={rate:.0f}/s eta={eta:.0f}s"
+        )
+
+    if workers <= 1:
+        for uids in _iter_uid_batches(batch_size):
+            report(*rebuild_batch(uids, *job))
+    else:
+        # spawn, not fork: the parent holds an open server-side cursor and a
+        # forked child must not inherit (and later close) that connection
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            pending = set()
+            for uids in _iter_uid_batches(batch_size):
+                pending.add(pool.submit(rebuild_batch, uids, *job))
+                if len(pending) >= 2 * workers:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in finished:
+                        report(*f.result())
+            for f in pending:
+                report(*f.result())
+
+    elapsed = time.time() - t0
+    print(f"[rebuild] done users={done_users} events={done_events} elapsed={elapsed:.1f}s")
+    return {"users": done_users, "events": done_events, "elapsed_s": round(elapsed, 1)}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Rebuild all user_embeddings in bulk")
+    ap.add_argument("--k", type=int, default=30, help="recent events per user")
+    ap.add_argument("--batch-size", type=int, default=1000, help="users per batch")
+    ap.add_argument("--workers", type=int, default=1, help="worker processes")
+    ap.add_argument("--reweight", action="store_true",
+                    help="rewrite user_events.weight from EVENT_WEIGHTS first (overrides are kept)")
+    ap.add_argument("--column", choices=sorted(EMBEDDING_COLUMNS), default="embedding",
+                    help="embedding_next rebuilds the shadow profiles of a running migration")
+    args = ap.parse_args()
+    rebuild_all_user_embeddings(
+        k=args.k,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        reweight=args.reweight,
+        column=args.column,
+    )
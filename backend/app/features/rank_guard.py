@@ -0,0 +1,193 @@
+# app/features/rank_guard.py
+"""
+Latency budget, admission control and degraded tiers for /api/rank.
+
+Tiers, cheapest last:
+  personalized  full similarity + likes query (concurrency-capped)
+  cached        slice of the user's last personalised ranking (RANK_CACHE_DEPTH deep)
+  popular       global popularity list, refreshed by a background thread
+                every RANK_POPULAR_TTL_S; requests only ever read it
+
+rank() tries them in order; every request and every degradation is counted
+so /api/rank/stats shows how often (and why) we fell back. Users without a
+profile are counted as tier "cold_start", served from the popular list too,
+so they never show up as degraded.
+"""
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+from app.db import conn
+from app.settings import settings
+
+
+class BudgetExceeded(Exception):
+    """The request's latency budget ran out before the next query could start."""
+
+
+# -------------------- BUDGET --------------------
+
+class RankBudget:
+    def __init__(self, budget_ms: Optional[int] = None):
+        self.budget_ms = settings.RANK_BUDGET_MS if budget_ms is None else budget_ms
+        self.t0 = time.monotonic()
+
+    def remaining_ms(self) -> int:
+        return int(self.budget_ms - (time.monotonic() - self.t0) * 1000)
+
+    def connect(self):
+        """
+        Open a connection whose connect_timeout is what's left of the budget
+        (rounded up to whole seconds, libpq's granularity; its floor is 2s).
+        """
+        remaining = self.remaining_ms()
+        if remaining <= 0:
+            raise BudgetExceeded()
+        return conn(connect_timeout=max(2, math.ceil(remaining / 1000)))
+
+    def apply(self, cur):
+        """
+        Cap the next statements in this transaction at whatever budget is left.
+        Postgres cancels them with QueryCanceled when it runs out.
+        """
+        remaining = self.remaining_ms()
+        if remaining <= 0:
+            raise BudgetExceeded()
+        cur.execute("SET LOCAL statement_timeout = %s", (remaining,))
+
+
+# -------------------- ADMISSION CONTROL --------------------
+
+_personal_slots = threading.BoundedSemaphore(settings.RANK_MAX_CONCURRENCY)
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+
+@contextmanager
+def personalized_slot():
+    """Yields True if a personalised slot was free; never blocks."""
+    global _in_flight
+    acquired = _personal_slots.acquire(blocking=False)
+    if acquired:
+        with _in_flight_lock:
+            _in_flight += 1
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with _in_flight_lock:
+                _in_flight -= 1
+            _personal_slots.release()
+
+
+# -------------------- CACHES --------------------
+
+_PERSONAL_CACHE_MAX = 10_000
+_personal_cache: "OrderedDict[str, tuple[float, List[str], bool]]" = OrderedDict()
+_personal_lock = threading.Lock()
+
+
+def cache_personalized(uid: str, ranked: List[str], complete: bool):
+    """
+    Remember the user's latest ranking: the whole list fetched, not just the
+    page served. `complete` means it holds every eligible post (the query came
+    back short), so a short slice really is the end of the feed.
+    """
+    with _personal_lock:
+        _personal_cache[uid] = (time.monotonic(), list(ranked), complete)
+        _personal_cache.move_to_end(uid)
+        while len(_personal_cache) > _PERSONAL_CACHE_MAX:
+            _personal_cache.popitem(last=False)
+
+
+def cached_personalized(uid: str, offset: int, limit: int) -> Optional[List[str]]:
+    """Page of the cached ranking, or None if expired, missing or past its depth."""
+    with _personal_lock:
+        hit = _personal_cache.get(uid)
+        if not hit:
+            return None
+        ts, ranked, complete = hit
+        if time.monotonic() - ts > settings.RANK_CACHE_TTL_S:
+            del _personal_cache[uid]
+            return None
+    page = ranked[offset:offset + limit]
+    if not page or (len(page) < limit and not complete):
+        return None
+    return page
+
+
+_POPULAR_SIZE = 1000
+_popular: dict = {"ts": 0.0, "post_ids": []}
+_popular_started = False
+_popular_start_lock = threading.Lock()
+
+
+def refresh_popular(loader: Callable[[int, int], List[str]]):
+    """One refresh of the popular list; on failure the previous copy stays."""
+    try:
+        post_ids = loader(_POPULAR_SIZE, settings.RANK_POPULAR_TIMEOUT_MS)
+    except Exception as e:
+        print(f"[rank] popular list refresh failed, keeping previous copy: {e}")
+        return
+    _popular["post_ids"] = post_ids
+    _popular["ts"] = time.monotonic()
+    print(f"[rank] popular list refreshed n={len(post_ids)}")
+
+
+def start_popular_refresher(loader: Callable[[int, int], List[str]]):
+    """
+    Keep the popular list fresh from a daemon thread, so a degraded request
+    never waits on Postgres for it. `loader(k, timeout_ms)` returns firebase ids.
+    """
+    global _popular_started
+    with _popular_start_lock:
+        if _popular_started:
+            return
+        _popular_started = True
+
+    def loop():
+        while True:
+            refresh_popular(loader)
+            # retry sooner while we still have nothing to serve
+            time.sleep(settings.RANK_POPULAR_TTL_S if _popular["post_ids"] else 5.0)
+
+    threading.Thread(target=loop, daemon=True).start()
+    print("[startup] popular list refresher started")
+
+
+def popular_ready() -> bool:
+    return bool(_popular["post_ids"])
+
+
+def popular_page(offset: int, limit: int) -> List[str]:
+    """Slice of the current popular list; never touches the database."""
+    return _popular["post_ids"][offset:offset + limit]
+
+
+# -------------------- COUNTERS --------------------
+
+_counts: Counter = Counter()
+_counts_lock = threading.Lock()
+
+
+def record(tier: str, reason: Optional[str] = None):
+    with _counts_lock:
+        _counts[f"tier.{tier}"] += 1
+        if reason:
+            _counts[f"degraded.{reason}"] += 1
+
+
+def stats() -> dict:
+    with _counts_lock:
+        counts = dict(_counts)
+    return {
+        "counts": counts,
+        "personalized_in_flight": _in_flight,
+        "max_concurrency": settings.RANK_MAX_CONCURRENCY,
+        "budget_ms": settings.RANK_BUDGET_MS,
+        "popular_size": len(_popular["post_ids"]),
+        "popular_age_s": round(time.monotonic() - _popular["ts"], 1) if _popular["ts"] else None,
+    }
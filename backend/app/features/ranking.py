@@ -0,0 +1,14 @@
+# app/features/ranking.py
+"""
+Score weights shared by /api/rank (SQL ORDER BY in main.py) and the batch
+ranker (NumPy in batch_rank.py). Keep them here so the two cannot drift.
+
+    score = cosine distance + min(FRESHNESS_CAP, age_h * FRESHNESS_PER_HOUR)
+                            - POPULARITY_ALPHA * ln(1 + likes)
+
+Lower is better.
+"""
+
+POPULARITY_ALPHA = 0.3      # how strongly likes affect ranking
+FRESHNESS_PER_HOUR = 0.002  # distance penalty per hour of post age
+FRESHNESS_CAP = 0.15        # max freshness penalty
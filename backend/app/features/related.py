@@ -0,0 +1,267 @@
+# app/features/related.py
+"""
+"More like this": a precomputed approximate kNN graph over posts.embedding.
+
+Each post's top-K neighbours live in post_neighbors as parallel int/real
+arrays, so serving /api/posts/{id}/related is one indexed read. The graph is
+built in bulk with one pgvector ANN query per post, batched server-side:
+
+    python -m app.features.related --k 30
+
+and kept fresh by `update_post_neighbors`, which `_compute_and_save_embedding`
+calls whenever a post gets a new vector. Rows remember the embedding_version
+they were built from and lookups skip stale-version rows.
+
+An embedding migration builds the next graph from embedding_next into
+post_neighbors_next before its cutover, and `swap_in_staging_graph` replaces
+post_neighbors with it inside the cutover transaction, so "more like this"
+never goes empty while the new vectors take over.
+"""
+import argparse
+import time
+from typing import List
+
+import psycopg2.extras
+
+from app.db import conn
+from app.features.embedding_versions import EMBEDDING_COLUMNS
+
+RELATED_K = 30          # neighbours stored per post
+IVFFLAT_PROBES = 10     # same recall/speed trade-off as rank()
+
+NEIGHBORS_TABLE = "post_neighbors"
+STAGING_NEIGHBORS_TABLE = "post_neighbors_next"
+
+
+def _upsert_neighbors_sql(column: str = "embedding", table: str = NEIGHBORS_TABLE) -> str:
+    """
+    For every post id in %(ids)s, find its K nearest same-version posts in
+    `column` through the ivfflat index and upsert them as one row of `table`.
+    Rows are written in id order so concurrent writers lock them in one order.
+    """
+    if table not in (NEIGHBORS_TABLE, STAGING_NEIGHBORS_TABLE):
+        raise ValueError(f"unknown neighbours table {table!r}")
+    emb_col, _, ver_col = EMBEDDING_COLUMNS[column]
+    return f"""
+        INSERT INTO {table} (post_id, neighbor_ids, scores, embedding_version, updated_at)
+        SELECT p.id, nn.ids, nn.scores, p.{ver_col}, now()
+        FROM posts p
+        CROSS JOIN LATERAL (
+          SELECT
+            array_agg(q.id ORDER BY q.dist)              AS ids,
+            array_agg((1 - q.dist)::real ORDER BY q.dist) AS scores
+          FROM (
+            SELECT q.id, q.{emb_col} <=> p.{emb_col} AS dist
+            FROM posts q
+            WHERE q.{emb_col} IS NOT NULL
+              AND q.id <> p.id
+              AND q.{ver_col} = p.{ver_col}
+            ORDER BY q.{emb_col} <=> p.{emb_col}
+            LIMIT %(k)s
+          ) q
+        ) nn
+        WHERE p.id = ANY(%(ids)s)
+          AND p.{emb_col} IS NOT NULL
+          AND nn.ids IS NOT NULL
+        ORDER BY p.id
+        ON CONFLICT (post_id) DO UPDATE
+        SET neighbor_ids      = EXCLUDED.neighbor_ids,
+            scores            = EXCLUDED.scores,
+            embedding_version = EXCLUDED.embedding_version,
+            updated_at        = now()
+        RETURNING post_id, neighbor_ids, scores, embedding_version
+    """
+
+
+# -------------------- LOOKUP --------------------
+
+def related_post_ids(firebase_id: str, limit: int = 20) -> List[str]:
+    """Neighbours of a post as firebase ids, nearest first. Stale-version rows are ignored."""
+    with conn() as c, c.cursor() as cur:
+        cur.execute(
+            """
+            SELECT q.firebase_id
+            FROM posts p
+            JOIN post_neighbors n
+              ON n.post_id = p.id
+             AND n.embedding_version = p.embedding_version
+            CROSS JOIN LATERAL unnest(n.neighbor_ids) WITH ORDINALITY AS u(id, ord)
+            JOIN posts q ON q.id = u.id
+            WHERE p.firebase_id = %s
+              AND q.firebase_id IS NOT NULL
+            ORDER BY u.ord
+            LIMIT %s
+            """,
+            (firebase_id, limit),
+        )
+        return [r[0] for r in cur.fetchall()]
+
+
+# -------------------- INCREMENTAL UPDATE --------------------
+
+def _merge_neighbor(ids: List[int], scores: List[float], new_id: int, new_score: float, k: int):
+    """Insert (new_id, new_score) into a nearest-first list, replacing any old entry; None if unchanged."""
+    pairs = [(i, s) for i, s in zip(ids, scores) if i != new_id]
+    pairs.append((new_id, new_score))
+    pairs.sort(key=lambda p: p[1], reverse=True)
+    new_ids = [i for i, _ in pairs[:k]]
+    new_scores = [s for _, s in pairs[:k]]
+    if new_ids == list(ids) and new_scores == list(scores):
+        return None
+    return new_ids, new_scores
+
+
+def update_post_neighbors(post_id: int, k: int = RELATED_K):
+    """
+    Recompute one post's neighbour row, then offer the post to each of its
+    neighbours' lists (cosine similarity is symmetric, so the score carries over).
+
+    The two steps are separate transactions. Neighbour lists are mostly
+    symmetric, so holding our own row while waiting for the neighbours' rows
+    would deadlock against a concurrent update of one of those neighbours
+    (embed worker, BackgroundTasks fallback, migration repair). The back-link
+    transaction locks its rows in post_id order and holds nothing else.
+    """
+    with conn() as c, c.cursor() as cur:
+        cur.execute("SET LOCAL ivfflat.probes = %s", (IVFFLAT_PROBES,))
+        cur.execute(_upsert_neighbors_sql(), {"ids": [post_id], "k": k})
+        row = cur.fetchone()
+    if not row:
+        print(f"[related] no neighbours for post_id={post_id}")
+        return
+    _, neighbor_ids, scores, version = row
+    score_of = dict(zip(neighbor_ids, scores))
+
+    with conn() as c, c.cursor() as cur:
+        cur.execute(
+            """
+            SELECT post_id, neighbor_ids, scores
+            FROM post_neighbors
+            WHERE post_id = ANY(%s) AND embedding_version = %s
+            ORDER BY post_id
+            FOR UPDATE
+            """,
+            (neighbor_ids, version),
+        )
+        updates = []
+        for nid, ids, sc in cur.fetchall():
+            merged = _merge_neighbor(ids, sc, post_id, score_of[nid], k)
+            if merged:
+                updates.append((nid, merged[0], merged[1]))
+
+        if updates:
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                UPDATE post_neighbors n
+                SET neighbor_ids = v.ids, scores = v.scores, updated_at = now()
+                FROM (VALUES %s) AS v(post_id, ids, scores)
+                WHERE n.post_id = v.post_id
+                """,
+                updates,
+                template="(%s, %s::int[], %s::real[])",
+            )
+    print(f"[related] updated post_id={post_id} neighbours={len(neighbor_ids)} back_links={len(updates)}")
+
+
+# -------------------- BULK BUILD --------------------
+
+def build_all_post_neighbors(
+    k: int = RELATED_K,
+    batch: int = 500,
+    column: str = "embedding",
+    table: str = NEIGHBORS_TABLE,
+    missing_only: bool = False,
+) -> int:
+    """
+    Build the graph over `column` into `table` in id-ordered batches; one
+    statement per batch. `missing_only` skips posts that already have a row
+    for their current version, which makes an interrupted build resumable.
+    """
+    emb_col, _, ver_col = EMBEDDING_COLUMNS[column]
+    upsert_sql = _upsert_neighbors_sql(column, table)
+    missing = f"""
+                  AND NOT EXISTS (
+                    SELECT 1 FROM {table} n
+                    WHERE n.post_id = posts.id AND n.embedding_version = posts.{ver_col}
+                  )""" if missing_only else ""
+
+    with conn() as c, c.cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM posts WHERE {emb_col} IS NOT NULL")
+        total = cur.fetchone()[0]
+    print(f"[related] build start table={table} column={column} posts={total} k={k} batch={batch}")
+
+    t0 = time.time()
+    last_id = 0
+    done = 0
+    while True:
+        with conn() as c, c.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT id FROM posts
+                WHERE id > %s AND {emb_col} IS NOT NULL{missing}
+                ORDER BY id
+                LIMIT %s
+                """,
+                (last_id, batch),
+            )
+            ids = [r[0] for r in cur.fetchall()]
+            if not ids:
+                break
+            cur.execute("SET LOCAL ivfflat.probes = %s", (IVFFLAT_PROBES,))
+            cur.execute(upsert_sql, {"ids": ids, "k": k})
+            done += cur.rowcount
+        last_id = ids[-1]
+        elapsed = time.time() - t0
+        print(f"[related] built {done}/{total} last_id={last_id} elapsed={elapsed:.1f}s")
+
+    print(f"[related] build done table={table} posts={done} elapsed={time.time() - t0:.1f}s")
+    return done
+
+
+# -------------------- STAGING (embedding migrations) --------------------
+
+def create_staging_graph():
+    """Empty post_neighbors_next, same shape as migrations/004_post_neighbors.sql."""
+    with conn() as c, c.cursor() as cur:
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {STAGING_NEIGHBORS_TABLE} (
+              post_id           INT    CONSTRAINT post_neighbors_next_pkey PRIMARY KEY
+                                       CONSTRAINT post_neighbors_next_post_id_fkey
+                                       REFERENCES posts(id) ON DELETE CASCADE,
+              neighbor_ids      INT[]  NOT NULL,
+              scores            REAL[] NOT NULL,
+              embedding_version INT    NOT NULL,
+              updated_at        TIMESTAMPTZ DEFAULT now()
+            )
+            """
+        )
+
+
+def swap_in_staging_graph(cur):
+    """
+    Replace post_neighbors with post_neighbors_next. Call inside the cutover
+    transaction so the graph flips together with the embedding columns.
+    Constraint names are moved over so the next migration can reuse them.
+    """
+    cur.execute(f"DROP TABLE {NEIGHBORS_TABLE}")
+    cur.execute(f"ALTER TABLE {STAGING_NEIGHBORS_TABLE} RENAME TO {NEIGHBORS_TABLE}")
+    cur.execute(f"ALTER TABLE {NEIGHBORS_TABLE} RENAME CONSTRAINT post_neighbors_next_pkey TO post_neighbors_pkey")
+    cur.execute(
+        f"ALTER TABLE {NEIGHBORS_TABLE} "
+        "RENAME CONSTRAINT post_neighbors_next_post_id_fkey TO post_neighbors_post_id_fkey"
+    )
+
+
+def drop_staging_graph():
+    with conn() as c, c.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {STAGING_NEIGHBORS_TABLE}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Build the post_neighbors kNN graph")
+    ap.add_argument("--k", type=int, default=RELATED_K, help="neighbours per post")
+    ap.add_argument("--batch", type=int, default=500, help="posts per statement")
+    args = ap.parse_args()
+    build_all_post_neighbors(k=args.k, batch=args.batch)
@@ -15,8 +15,10 @@ from .db import conn, ensure_pgvector_extension
 from .embeddings import cohere_embed
 from .utils import clean_text
 from .models import PostOut, ErrorOut
-from .models import UserEventIn
+from .models import UserEventIn, BatchRankIn
 from .features.posts import _compute_and_save_embedding
+from .features.related import related_post_ids
+from .features.embedding_versions import warn_if_settings_differ
 from .features.interactions import _fetch_recent_event_vectors,  _ensure_user, _resolve_post_id,_event_weight, _compute_weighted_profile,_maybe_recompute_user_embedding,upsert_user_embedding
 # --- NEW: simple embedding job queue to prevent API bursts ---
 import threading, queue, time, base64
@@ -78,7 +80,9 @@ def _ensure_worker():
 @app.on_event("startup")
 def _startup():
     ensure_pgvector_extension()
+    warn_if_settings_differ()
     _ensure_worker()
+    start_popular_refresher(_load_popular_list)
     print("[startup] pgvector ensured & worker online")
 
 @app.get("/healthz")
@@ -167,6 +171,17 @@ async def create_post(
 
     return PostOut(id=row["id"], title=row["title"], body=row["body"])
 
+@app.get("/api/posts/{firebase_id}/related")
+def related_posts(firebase_id: str, limit: int = 20):
+    """
+    "More like this" for a post, served from the precomputed post_neighbors graph.
+    Empty until the post has been embedded.
+    """
+    limit = min(max(limit, 1), 50)
+    ids = related_post_ids(firebase_id, limit)
+    print(f"[related] firebase_id={firebase_id} returning {len(ids)} posts")
+    return {"post_ids": ids}
+
 # -------------------- USER EVENTS & EMBEDDINGS --------------------
 
 
@@ -182,8 +197,9 @@ def user_event(evt: UserEventIn, request: Request, bg: BackgroundTasks):
 
     with conn() as c, c.cursor() as cur:
         cur.execute(
-            "INSERT INTO user_events(uid, post_id, etype, weight) VALUES(%s,%s,%s,%s)",
-            (evt.uid, pid, evt.etype, w),
+            # the raw override is kept so `profile_rebuild --reweight` leaves it alone
+            "INSERT INTO user_events(uid, post_id, etype, weight, weight_override) VALUES(%s,%s,%s,%s,%s)",
+            (evt.uid, pid, evt.etype, w, evt.weight),
         )
     print(f"[event] inserted user_event uid={evt.uid} post_id={pid} etype={evt.etype} weight={w}")
 
@@ -215,8 +231,59 @@ import psycopg2.extras
 from typing import List, Any
 import json
 from fastapi import HTTPException
+from psycopg2.errors import QueryCanceled
+from .features.rank_guard import (
+    BudgetExceeded,
+    RankBudget,
+    cache_personalized,
+    cached_personalized,
+    personalized_slot,
+    popular_page,
+    popular_ready,
+    record,
+    start_popular_refresher,
+    stats as rank_stats,
+)
 
-POPULARITY_ALPHA = 0.3  # how strongly likes affect ranking
+from .features.ranking import POPULARITY_ALPHA, FRESHNESS_PER_HOUR, FRESHNESS_CAP
+from .features.batch_rank import rank_users, shared_candidate_cache
+
+MAX_BATCH_UIDS = 10_000
+_batch_slots = threading.BoundedSemaphore(settings.BATCH_RANK_MAX_CONCURRENCY)
+
+
+# Utility to fetch recent *popular* posts, used for cold-start + top-up
+def _latest_posts_fbids(k: int, offset: int, budget: RankBudget) -> list[str]:
+    if k <= 0:
+        return []
+    with budget.connect() as c, c.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        budget.apply(cur)
+        cur.execute(
+            """
+            WITH post_likes AS (
+              SELECT post_id, COUNT(*) AS likes
+              FROM user_events
+              WHERE etype = 'like'
+              GROUP BY post_id
+            )
+            SELECT p.firebase_id
+            FROM posts p
+            LEFT JOIN post_likes pl ON pl.post_id = p.id
+            WHERE p.embedding IS NOT NULL
+              AND p.firebase_id IS NOT NULL
+            ORDER BY
+              COALESCE(pl.likes, 0) DESC,
+              p.created_at DESC
+            LIMIT %s OFFSET %s
+            """,
+            (k, offset),
+        )
+        return [r["firebase_id"] for r in cur.fetchall() if r["firebase_id"]]
+
+
+def _load_popular_list(k: int, timeout_ms: int) -> list[str]:
+    # runs on the refresher thread, on its own timeout rather than a request's budget
+    return _latest_posts_fbids(k, 0, RankBudget(timeout_ms))
 
 
 @app.get("/api/rank")
@@ -226,15 +293,48 @@ def rank(uid: str, limit: int = 15, cursor: int = 0):
       - user embedding similarity
       - freshness (newer posts slightly favored)
       - global popularity via like counts
+
+    Runs under a latency budget (RANK_BUDGET_MS): connections and queries get
+    what is left of it as connect_timeout / statement_timeout, and the
+    personalised path is capped at RANK_MAX_CONCURRENCY. Past either limit, or
+    if Postgres is unreachable, we degrade to a slice of the user's cached
+    ranking, then the global popularity list; `tier` says which served.
+    Users without a profile get tier "cold_start" (not a degradation).
     """
     limit = min(max(limit, 1), 200)
     offset = int(cursor)
+    budget = RankBudget()
     print(f"[rank] computing recommendations for uid={uid} limit={limit} offset={offset}")
 
-    # 1) Load user embedding
-    with conn() as c, c.cursor() as cur:
-        cur.execute("SELECT embedding FROM user_embeddings WHERE uid = %s", (uid,))
-        row = cur.fetchone()
+    def respond(post_ids: list[str], tier: str, reason: str | None = None) -> dict:
+        record(tier, reason)
+        next_cursor = offset + limit if len(post_ids) == limit else None
+        why = f" reason={reason}" if reason else ""
+        print(f"[rank] returning {len(post_ids)} posts tier={tier}{why} next_cursor={next_cursor}")
+        return {"post_ids": post_ids, "next_cursor": next_cursor, "tier": tier}
+
+    def degraded(reason: str) -> dict:
+        cached = cached_personalized(uid, offset, limit)
+        if cached is not None:
+            return respond(cached, "cached", reason)
+        if not popular_ready():
+            # an empty page with next_cursor=None would read as "end of feed"
+            record("unavailable", reason)
+            print(f"[rank] no fallback available yet reason={reason}")
+            raise HTTPException(status_code=503, detail="Ranking temporarily unavailable",
+                                headers={"Retry-After": "5"})
+        return respond(popular_page(offset, limit), "popular", reason)
+
+    # 1) Load user embedding (+ its version: only same-version posts are comparable)
+    try:
+        with budget.connect() as c, c.cursor() as cur:
+            budget.apply(cur)
+            cur.execute("SELECT embedding, embedding_version FROM user_embeddings WHERE uid = %s", (uid,))
+            row = cur.fetchone()
+    except (QueryCanceled, BudgetExceeded):
+        return degraded("timeout")
+    except psycopg2.OperationalError:
+        return degraded("db_error")
 
     def coerce_embedding(x: Any) -> List[float] | None:
         if x is None:
@@ -251,50 +351,57 @@ def rank(uid: str, limit: int = 15, cursor: int = 0):
         return None
 
     uvec = coerce_embedding(row[0]) if row else None
+    uversion = row[1] if row else None
 
-    # Utility to fetch recent *popular* posts, used for cold-start + top-up
-    def latest_posts_fbids(k: int, offset: int = 0) -> list[str]:
-        if k <= 0:
-            return []
-        with conn() as c, c.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(
-                """
-                WITH post_likes AS (
-                  SELECT post_id, COUNT(*) AS likes
-                  FROM user_events
-                  WHERE etype = 'like'
-                  GROUP BY post_id
-                )
-                SELECT p.firebase_id
-                FROM posts p
-                LEFT JOIN post_likes pl ON pl.post_id = p.id
-                WHERE p.embedding IS NOT NULL
-                  AND p.firebase_id IS NOT NULL
-                ORDER BY
-                  COALESCE(pl.likes, 0) DESC,
-                  p.created_at DESC
-                LIMIT %s OFFSET %s
-                """,
-                (k, offset),
-            )
-            return [r["firebase_id"] for r in cur.fetchall() if r["firebase_id"]]
-
-    # 2) If user embedding missing → popularity + recency fallback
+    # 2) If user embedding missing → popularity + recency fallback, from the
+    #    in-memory popular list; only query when it's not loaded or too short
     if not uvec:
         print(f"[rank] no embedding for {uid}, returning popularity-weighted fallback")
-        latest = latest_posts_fbids(limit, offset)
+        latest = popular_page(offset, limit)
+        if len(latest) < limit:
+            try:
+                latest = _latest_posts_fbids(limit, offset, budget)
+            except (QueryCanceled, BudgetExceeded):
+                return degraded("timeout")
+            except psycopg2.OperationalError:
+                return degraded("db_error")
         random.shuffle(latest)
-        next_cursor = offset + limit if len(latest) == limit else None
-        return {"post_ids": latest, "next_cursor": next_cursor}
+        return respond(latest, "cold_start")
 
-    # 3) Ranked query using pgvector + likes
-    print(f"[rank] user embedding found, running similarity + likes query")
-    with conn() as c, c.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with personalized_slot() as admitted:
+        if not admitted:
+            return degraded("concurrency")
+        try:
+            merged, ranked, complete = _personalized_fbids(uvec, uversion, limit, offset, budget)
+        except (QueryCanceled, BudgetExceeded):
+            return degraded("timeout")
+        except psycopg2.OperationalError:
+            return degraded("db_error")
+
+    cache_personalized(uid, ranked, complete)
+    return respond(merged, "personalized")
+
+
+def _personalized_fbids(
+    uvec: List[float], uversion: int, limit: int, offset: int, budget: RankBudget
+) -> tuple[list[str], list[str], bool]:
+    """
+    Steps 3-5 of rank(); every connection and query runs under `budget`.
+    Returns (page, ranked, complete): `ranked` is the pure similarity ranking
+    from the top, at least RANK_CACHE_DEPTH deep, for the per-user cache, and
+    `complete` says it ran out of posts before that depth.
+    """
+    # 3) Ranked query using pgvector + likes; fetched from the top so later
+    #    pages can be served from the cache if the next request has to degrade
+    depth = max(offset + limit, settings.RANK_CACHE_DEPTH)
+    print(f"[rank] user embedding found, running similarity + likes query depth={depth}")
+    with budget.connect() as c, c.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
         try:
             cur.execute("SET LOCAL ivfflat.probes = %s", (10,))
         except Exception:
             pass
 
+        budget.apply(cur)
         cur.execute(
             """
             WITH post_likes AS (
@@ -309,31 +416,35 @@ def rank(uid: str, limit: int = 15, cursor: int = 0):
             LEFT JOIN post_likes pl ON pl.post_id = p.id
             WHERE p.embedding IS NOT NULL
               AND p.firebase_id IS NOT NULL
+              AND p.embedding_version = %s
             ORDER BY
               -- similarity (lower is better)
               (p.embedding <=> (%s)::float4[]::vector)
-              -- freshness penalty (caps at 0.15)
+              -- freshness penalty (caps at FRESHNESS_CAP)
               + LEAST(
-                  0.15,
+                  %s,
                   GREATEST(
                     0.0,
-                    (EXTRACT(EPOCH FROM (now() - p.created_at))/3600.0) * 0.002
+                    (EXTRACT(EPOCH FROM (now() - p.created_at))/3600.0) * %s
                   )
                 )
               -- popularity reward: more likes → lower score
               - %s * LN(1 + COALESCE(pl.likes, 0))
-            LIMIT %s OFFSET %s
+            LIMIT %s
             """,
-            (uvec, POPULARITY_ALPHA, limit, offset),
+            (uversion, uvec, FRESHNESS_CAP, FRESHNESS_PER_HOUR, POPULARITY_ALPHA, depth),
         )
         ranked_rows = cur.fetchall()
 
+    complete = len(ranked_rows) < depth
     ranked = [r["firebase_id"] for r in ranked_rows if r["firebase_id"]]
+    page = ranked[offset:offset + limit]
 
     # 4) Diversity: random but biased toward popular posts
     RANDOM_COUNT = min(5, limit)
     random_fbids: list[str] = []
-    with conn() as c, c.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with budget.connect() as c, c.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        budget.apply(cur)
         cur.execute(
             """
             WITH post_likes AS (
@@ -355,7 +466,7 @@ def rank(uid: str, limit: int = 15, cursor: int = 0):
             (limit * 3,),
         )
         pool = [r["firebase_id"] for r in cur.fetchall() if r["firebase_id"]]
-        seen = set(ranked)
+        seen = set(page)
         for fbid in pool:
             if fbid not in seen:
                 random_fbids.append(fbid)
@@ -363,11 +474,11 @@ def rank(uid: str, limit: int = 15, cursor: int = 0):
                 if len(random_fbids) >= RANDOM_COUNT:
                     break
 
-    merged = (random_fbids + [fbid for fbid in ranked if fbid not in random_fbids])[:limit]
+    merged = (random_fbids + [fbid for fbid in page if fbid not in random_fbids])[:limit]
 
     # 5) Top up if short
     if len(merged) < limit:
-        topup = latest_posts_fbids(limit * 2, offset)
+        topup = _latest_posts_fbids(limit * 2, offset, budget)
         seen = set(merged)
         for fbid in topup:
             if fbid not in seen:
@@ -375,6 +486,43 @@ def rank(uid: str, limit: int = 15, cursor: int = 0):
                 if len(merged) >= limit:
                     break
 
-    next_cursor = offset + limit if len(merged) == limit else None
-    print(f"[rank] returning {len(merged)} posts next_cursor={next_cursor}")
-    return {"post_ids": merged, "next_cursor": next_cursor}
+    return merged, ranked, complete
+
+
+@app.post("/api/rank/batch")
+def rank_batch(req: BatchRankIn, request: Request):
+    """
+    Top-N feeds for many users in one call (digests, precompute). Scores with
+    the same similarity/freshness/popularity terms as rank(), one matrix
+    multiply per chunk of users; see app/features/batch_rank.py.
+
+    Candidates are capped at the 20k most recent posts to bound memory,
+    while rank() scores every post, so results can differ from rank()'s for
+    the same user. All calls share one TTL-cached candidate set
+    and at most BATCH_RANK_MAX_CONCURRENCY run at once (429 otherwise);
+    ranking the whole user base belongs in the batch_rank CLI.
+    """
+    _verify_webhook_secret(request)
+    if len(req.uids) > MAX_BATCH_UIDS:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_BATCH_UIDS} uids per call")
+    limit = min(max(req.limit, 1), 200)
+    if not _batch_slots.acquire(blocking=False):
+        raise HTTPException(status_code=429, detail="Batch ranking busy, retry later",
+                            headers={"Retry-After": "10"})
+    try:
+        print(f"[batch-rank] request users={len(req.uids)} limit={limit}")
+        results = rank_users(
+            req.uids,
+            limit=limit,
+            workers=settings.BATCH_RANK_WORKERS,
+            cache=shared_candidate_cache(),
+        )
+        return {"results": dict(results)}
+    finally:
+        _batch_slots.release()
+
+
+@app.get("/api/rank/stats")
+def rank_guard_stats():
+    """Tier / degradation counters for /api/rank since process start."""
+    return rank_stats()
@@ -48,3 +48,8 @@ class UserEventIn(BaseModel):
     firebase_post_id: str | None = None
     post_id: int | None = None
     weight: float | None = None  # optional override
+
+
+class BatchRankIn(BaseModel):
+    uids: List[str]
+    limit: int = 15
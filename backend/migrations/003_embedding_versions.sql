@@ -0,0 +1,39 @@
+-- 003_embedding_versions.sql
+-- Registry of embedding model versions. Exactly one version is 'active'
+-- (served from posts.embedding / user_embeddings.embedding); at most one is
+-- 'shadow' (being backfilled into the embedding_next columns, which are added
+-- by app.features.embedding_migration because their dimension is only known
+-- when a migration starts).
+CREATE TABLE embedding_versions (
+  version        INT  PRIMARY KEY,
+  model          TEXT NOT NULL,
+  dim            INT  NOT NULL,
+  state          TEXT NOT NULL DEFAULT 'shadow',  -- 'shadow' | 'active' | 'retired'
+  created_at     TIMESTAMPTZ DEFAULT now(),
+  activated_at   TIMESTAMPTZ
+);
+
+-- one active and at most one shadow version at a time
+CREATE UNIQUE INDEX embedding_versions_state_uq
+  ON embedding_versions (state) WHERE state IN ('active', 'shadow');
+
+-- Version 1 is whatever the existing vectors were embedded with: the model
+-- recorded on the posts themselves and the declared dimension of
+-- posts.embedding (pgvector keeps it in atttypmod). The literals are only
+-- used on a database that has neither.
+INSERT INTO embedding_versions (version, model, dim, state, activated_at)
+SELECT
+  1,
+  COALESCE(
+    (SELECT embedding_model FROM posts
+     WHERE embedding IS NOT NULL AND embedding_model IS NOT NULL
+     GROUP BY embedding_model ORDER BY COUNT(*) DESC LIMIT 1),
+    'embed-v4.0'
+  ),
+  COALESCE(
+    (SELECT NULLIF(atttypmod, -1) FROM pg_attribute
+     WHERE attrelid = 'posts'::regclass AND attname = 'embedding' AND NOT attisdropped),
+    1536
+  ),
+  'active',
+  now();
@@ -0,0 +1,10 @@
+-- 004_post_neighbors.sql
+-- Precomputed approximate kNN graph over posts.embedding for "more like this".
+-- One row per post; neighbours stored as parallel arrays, nearest first.
+CREATE TABLE post_neighbors (
+  post_id           INT    PRIMARY KEY REFERENCES posts(id) ON DELETE CASCADE,
+  neighbor_ids      INT[]  NOT NULL,
+  scores            REAL[] NOT NULL,   -- cosine similarity, parallel to neighbor_ids
+  embedding_version INT    NOT NULL,   -- version of the vectors the graph was built from
+  updated_at        TIMESTAMPTZ DEFAULT now()
+);
@@ -0,0 +1,7 @@
+-- 005_event_weight_override.sql
+-- Remember the caller-supplied weight of an event separately from the
+-- effective one, so `profile_rebuild --reweight` can rewrite user_events.weight
+-- from new per-etype defaults without clobbering explicit overrides.
+-- Events recorded before this migration have NULL here and are treated as
+-- using the default (the override, if any, was not kept).
+ALTER TABLE user_events ADD COLUMN weight_override REAL;
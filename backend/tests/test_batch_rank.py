@@ -0,0 +1,63 @@
+import numpy as np
+
+from app.features.batch_rank import _Candidates, _top_n
+
+
+def _candidates(rng, c, d):
+    P = rng.standard_normal((c, d)).astype(np.float32)
+    P /= np.linalg.norm(P, axis=1, keepdims=True)
+    bias = rng.uniform(-0.3, 0.15, size=c).astype(np.float32)
+    fbids = np.array([f"p{i}" for i in range(c)], dtype=object)
+    return _Candidates(fbids, P, bias, fbids.tolist())
+
+
+def _brute_force(U, cand, n):
+    Un = U / np.linalg.norm(U, axis=1, keepdims=True)
+    D = 1.0 - Un @ cand.P.T + cand.bias[None, :]
+    return np.argsort(D, axis=1)[:, :n]
+
+
+def test_top_n_matches_full_argsort():
+    rng = np.random.default_rng(0)
+    cand = _candidates(rng, 500, 16)
+    U = rng.standard_normal((7, 16)).astype(np.float32)
+    np.testing.assert_array_equal(_top_n(U, cand, 15), _brute_force(U, cand, 15))
+
+
+def test_top_n_larger_than_candidates_returns_all_sorted():
+    rng = np.random.default_rng(1)
+    cand = _candidates(rng, 10, 8)
+    U = rng.standard_normal((3, 8)).astype(np.float32)
+    idx = _top_n(U, cand, 50)
+    assert idx.shape == (3, 10)
+    np.testing.assert_array_equal(idx, _brute_force(U, cand, 10))
+
+
+def test_top_n_zero_user_vector_ranks_by_bias():
+    rng = np.random.default_rng(2)
+    cand = _candidates(rng, 40, 8)
+    idx = _top_n(np.zeros((1, 8), dtype=np.float32), cand, 5)
+    np.testing.assert_array_equal(idx[0], np.argsort(cand.bias)[:5])
+
+
+def test_rank_users_resolves_active_version_once(monkeypatch):
+    from app.features import batch_rank
+
+    calls = []
+
+    def fake_active_spec():
+        calls.append(1)
+        return {"version": 1}
+
+    class _Cache:
+        def get(self, version):
+            return _Candidates(np.empty(0, dtype=object), np.empty((0, 0), dtype=np.float32),
+                               np.empty(0, dtype=np.float32), ["p0", "p1", "p2"])
+
+    monkeypatch.setattr(batch_rank, "active_spec", fake_active_spec)
+    monkeypatch.setattr(batch_rank, "_load_user_chunk", lambda uids: [])
+
+    out = dict(batch_rank.rank_users([f"u{i}" for i in range(10)], limit=2, chunk_size=3, cache=_Cache()))
+
+    assert len(calls) == 1
+    assert out == {f"u{i}": ["p0", "p1"] for i in range(10)}
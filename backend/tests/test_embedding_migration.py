@@ -0,0 +1,131 @@
+import pytest
+
+from app.features import embedding_migration, posts
+
+
+class _FakeDB:
+    """
+    Stands in for conn(): records every statement and answers from queues.
+    `rowcounts` is consumed by UPDATEs, `fetches` by fetchone() calls.
+    """
+
+    def __init__(self, fetches=(), rowcounts=()):
+        self.fetches = list(fetches)
+        self.rowcounts = list(rowcounts)
+        self.executed = []
+        self.rowcount = 0
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self, *args, **kwargs):
+        return self
+
+    def execute(self, sql, params=None):
+        self.executed.append((" ".join(sql.split()), params))
+        if sql.lstrip().startswith("UPDATE"):
+            self.rowcount = self.rowcounts.pop(0)
+
+    def fetchone(self):
+        return self.fetches.pop(0)
+
+    def updates(self):
+        return [(sql, params) for sql, params in self.executed if sql.startswith("UPDATE")]
+
+
+_V1 = {"version": 1, "model": "embed-v4.0", "dim": 1536, "registered": True}
+_V2 = {"version": 2, "model": "embed-v5.0", "dim": 1024, "registered": True}
+
+
+@pytest.fixture
+def embed_calls(monkeypatch):
+    calls = []
+
+    def fake_embed(text, img, input_type, output_dimension, model):
+        calls.append((model, output_dimension))
+        return [0.1] * 4
+
+    monkeypatch.setattr(posts, "cohere_embed", fake_embed)
+    monkeypatch.setattr(posts, "update_post_neighbors", lambda post_id: None)
+    monkeypatch.setattr(posts, "shadow_spec", lambda: None)
+    return calls
+
+
+def test_save_is_guarded_on_active_version(monkeypatch, embed_calls):
+    db = _FakeDB(fetches=[{"title": "t", "body": "b"}], rowcounts=[1])
+    monkeypatch.setattr(posts, "conn", db)
+    monkeypatch.setattr(posts, "active_spec", lambda: _V1)
+
+    posts._compute_and_save_embedding(7, "fb7", "t b", None)
+
+    (sql, params), = db.updates()
+    assert "state = 'active'" in sql
+    assert params[1:] == ("embed-v4.0", 1, 7, 1)
+    assert embed_calls == [("embed-v4.0", 1536)]
+
+
+def test_retries_with_new_spec_when_cutover_lands_mid_job(monkeypatch, embed_calls):
+    db = _FakeDB(fetches=[{"title": "t", "body": "b"}], rowcounts=[0, 1])
+    specs = iter([_V1, _V2])
+    monkeypatch.setattr(posts, "conn", db)
+    monkeypatch.setattr(posts, "active_spec", lambda: next(specs))
+
+    posts._compute_and_save_embedding(7, "fb7", "t b", None)
+
+    first, second = db.updates()
+    assert first[1][-1] == 1 and second[1][-1] == 2
+    assert embed_calls == [("embed-v4.0", 1536), ("embed-v5.0", 1024)]
+
+
+def test_both_attempts_failing_is_logged_not_saved(monkeypatch, capsys, embed_calls):
+    db = _FakeDB(fetches=[{"title": "t", "body": "b"}], rowcounts=[0, 0])
+    neighbours = []
+    monkeypatch.setattr(posts, "conn", db)
+    monkeypatch.setattr(posts, "active_spec", lambda: _V1)
+    monkeypatch.setattr(posts, "update_post_neighbors", neighbours.append)
+
+    posts._compute_and_save_embedding(7, "fb7", "t b", None)
+
+    out = capsys.readouterr().out
+    assert "FAILED post_id=7" in out
+    assert "saved post_id=7" not in out
+    assert neighbours == []
+
+
+def test_unregistered_spec_skips_guard(monkeypatch, embed_calls):
+    db = _FakeDB(fetches=[{"title": "t", "body": "b"}], rowcounts=[1])
+    monkeypatch.setattr(posts, "conn", db)
+    monkeypatch.setattr(posts, "active_spec", lambda: dict(_V1, registered=False))
+
+    posts._compute_and_save_embedding(7, "fb7", "t b", None)
+
+    (sql, params), = db.updates()
+    assert "embedding_versions" not in sql
+    assert params[-1] == 7
+
+
+def test_start_rejects_leftover_column_with_other_dim(monkeypatch):
+    monkeypatch.setattr(embedding_migration, "shadow_spec", lambda: None)
+    monkeypatch.setattr(embedding_migration, "_has_column", lambda table, column: False)
+    monkeypatch.setattr(embedding_migration, "_vector_dim", lambda table, column: 1536)
+    monkeypatch.setattr(embedding_migration, "conn", lambda: pytest.fail("must not touch the schema"))
+
+    with pytest.raises(RuntimeError, match="vector\\(1536\\), not vector\\(1024\\)"):
+        embedding_migration.start("embed-v5.0", 1024)
+
+
+def test_start_accepts_leftover_column_with_same_dim(monkeypatch):
+    db = _FakeDB(fetches=[(2,)])
+    monkeypatch.setattr(embedding_migration, "shadow_spec", lambda: None)
+    monkeypatch.setattr(embedding_migration, "_has_column", lambda table, column: False)
+    monkeypatch.setattr(embedding_migration, "_vector_dim", lambda table, column: 1024)
+    monkeypatch.setattr(embedding_migration, "conn", db)
+
+    assert embedding_migration.start("embed-v5.0", 1024) == {"version": 2, "model": "embed-v5.0", "dim": 1024}
+    assert any("vector(1024)" in sql for sql, _ in db.executed)
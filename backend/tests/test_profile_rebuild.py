@@ -0,0 +1,71 @@
+import numpy as np
+
+from app.features import profile_rebuild
+from app.features.interactions import _compute_weighted_profile
+from app.features.profile_rebuild import _compute_grouped_profiles, _iter_uid_batches
+
+
+def test_grouped_profiles_match_per_user_profile():
+    rng = np.random.default_rng(0)
+    sizes = {"alice": 3, "bob": 1, "carol": 7}
+    uids, vecs, weights = [], [], []
+    for uid, n in sizes.items():
+        uids += [uid] * n
+        vecs.append(rng.normal(size=(n, 16)).astype(np.float32))
+        weights += list(rng.uniform(0.5, 6.0, size=n))
+    V = np.concatenate(vecs)
+    W = np.array(weights, dtype=np.float32)
+
+    out_uids, Q, counts = _compute_grouped_profiles(np.array(uids, dtype=object), V, W)
+
+    assert list(out_uids) == list(sizes)
+    assert list(counts) == list(sizes.values())
+    start = 0
+    for i, n in enumerate(sizes.values()):
+        expected = _compute_weighted_profile(V[start:start + n].tolist(), W[start:start + n].tolist())
+        np.testing.assert_allclose(Q[i], expected, atol=1e-6)
+        start += n
+
+
+def test_grouped_profiles_zero_vectors_stay_finite():
+    V = np.zeros((2, 4), dtype=np.float32)
+    W = np.ones(2, dtype=np.float32)
+    _, Q, _ = _compute_grouped_profiles(np.array(["u", "u"], dtype=object), V, W)
+    assert np.all(np.isfinite(Q))
+
+
+class _FakeUsers:
+    """Stands in for conn(): answers the keyset query from a sorted uid list."""
+
+    def __init__(self, uids):
+        self.uids = sorted(uids)
+        self.opened = 0
+
+    def __call__(self):
+        self.opened += 1
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        last_uid, limit = params
+        self.rows = [(u,) for u in self.uids if u > last_uid][:limit]
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_uid_batches_page_by_keyset(monkeypatch):
+    fake = _FakeUsers([f"u{i:02d}" for i in range(7)])
+    monkeypatch.setattr(profile_rebuild, "conn", fake)
+    batches = list(_iter_uid_batches(3))
+    assert batches == [["u00", "u01", "u02"], ["u03", "u04", "u05"], ["u06"]]
+    # one short transaction per page (+1 for the empty page that ends it)
+    assert fake.opened == 4
@@ -0,0 +1,131 @@
+import time
+
+import pytest
+
+from app.features import rank_guard
+from app.features.rank_guard import (
+    BudgetExceeded,
+    RankBudget,
+    cache_personalized,
+    cached_personalized,
+    personalized_slot,
+    popular_page,
+    refresh_popular,
+)
+from app.settings import settings
+
+
+class _FakeCursor:
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+
+def test_budget_apply_sets_remaining_as_statement_timeout():
+    cur = _FakeCursor()
+    RankBudget(500).apply(cur)
+    (sql, (ms,)), = cur.executed
+    assert "statement_timeout" in sql
+    assert 0 < ms <= 500
+
+
+def test_budget_exhausted_raises_without_querying():
+    budget = RankBudget(0)
+    cur = _FakeCursor()
+    with pytest.raises(BudgetExceeded):
+        budget.apply(cur)
+    with pytest.raises(BudgetExceeded):
+        budget.connect()
+    assert cur.executed == []
+
+
+def test_personalized_slot_caps_concurrency(monkeypatch):
+    import threading
+    monkeypatch.setattr(rank_guard, "_personal_slots", threading.BoundedSemaphore(1))
+    with personalized_slot() as first:
+        with personalized_slot() as second:
+            assert first and not second
+    with personalized_slot() as again:
+        assert again
+
+
+def test_cached_ranking_is_sliced_per_page():
+    ranked = [f"p{i}" for i in range(50)]
+    cache_personalized("u-slice", ranked, complete=False)
+    assert cached_personalized("u-slice", 0, 10) == ranked[:10]
+    assert cached_personalized("u-slice", 20, 10) == ranked[20:30]
+    # past the cached depth: not known to be the end of the feed
+    assert cached_personalized("u-slice", 45, 10) is None
+    assert cached_personalized("u-other", 0, 10) is None
+
+
+def test_complete_cached_ranking_serves_short_last_page():
+    cache_personalized("u-short", ["a", "b", "c"], complete=True)
+    assert cached_personalized("u-short", 2, 10) == ["c"]
+    assert cached_personalized("u-short", 3, 10) is None
+
+
+def test_cached_ranking_expires(monkeypatch):
+    cache_personalized("u-old", ["a", "b"], complete=True)
+    later = time.monotonic() + settings.RANK_CACHE_TTL_S + 1
+    monkeypatch.setattr(rank_guard.time, "monotonic", lambda: later)
+    assert cached_personalized("u-old", 0, 2) is None
+
+
+def test_popular_page_slices_and_keeps_copy_on_failed_refresh(monkeypatch):
+    monkeypatch.setitem(rank_guard._popular, "post_ids", [])
+    refresh_popular(lambda k, ms: [f"p{i}" for i in range(k)])
+    assert popular_page(10, 5) == ["p10", "p11", "p12", "p13", "p14"]
+
+    def failing(k, ms):
+        raise RuntimeError("db down")
+
+    refresh_popular(failing)
+    assert popular_page(0, 2) == ["p0", "p1"]
+
+
+class _NoProfileDB:
+    """conn() stand-in for a user without a profile; counts connections."""
+
+    def __init__(self):
+        self.opened = 0
+
+    def __call__(self, *args, **kwargs):
+        self.opened += 1
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self, *args, **kwargs):
+        return self
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchone(self):
+        return None
+
+
+def test_cold_start_is_served_from_popular_list(monkeypatch):
+    from app import main
+
+    db = _NoProfileDB()
+    monkeypatch.setattr(rank_guard, "conn", db)
+    monkeypatch.setitem(rank_guard._popular, "post_ids", [f"p{i}" for i in range(100)])
+    before = rank_guard.stats()["counts"]
+
+    out = main.rank(uid="new-user", limit=10, cursor=20)
+
+    assert out["tier"] == "cold_start"
+    assert sorted(out["post_ids"]) == sorted(f"p{i}" for i in range(20, 30))
+    assert out["next_cursor"] == 30
+    assert db.opened == 1  # the profile lookup only, no popularity query
+    counts = rank_guard.stats()["counts"]
+    assert counts.get("tier.cold_start", 0) == before.get("tier.cold_start", 0) + 1
+    assert counts.get("tier.popular", 0) == before.get("tier.popular", 0)
@@ -0,0 +1,81 @@
+import pytest
+
+from app.features import related
+from app.features.related import STAGING_NEIGHBORS_TABLE, _merge_neighbor, _upsert_neighbors_sql
+
+
+def test_merge_inserts_in_score_order():
+    merged = _merge_neighbor([1, 2, 3], [0.9, 0.7, 0.5], 9, 0.8, k=3)
+    assert merged == ([1, 9, 2], [0.9, 0.8, 0.7])
+
+
+def test_merge_below_worst_of_full_list_is_noop():
+    assert _merge_neighbor([1, 2, 3], [0.9, 0.7, 0.5], 9, 0.1, k=3) is None
+
+
+def test_merge_appends_when_list_not_full():
+    assert _merge_neighbor([1], [0.9], 9, 0.1, k=3) == ([1, 9], [0.9, 0.1])
+
+
+def test_merge_replaces_existing_entry():
+    merged = _merge_neighbor([1, 9, 2], [0.9, 0.8, 0.7], 9, 0.95, k=3)
+    assert merged == ([9, 1, 2], [0.95, 0.9, 0.7])
+
+
+def test_merge_same_score_for_existing_entry_is_noop():
+    assert _merge_neighbor([1, 9], [0.9, 0.8], 9, 0.8, k=3) is None
+
+
+def test_staging_sql_uses_shadow_columns():
+    sql = _upsert_neighbors_sql("embedding_next", STAGING_NEIGHBORS_TABLE)
+    assert "INSERT INTO post_neighbors_next" in sql
+    assert "q.embedding_next <=> p.embedding_next" in sql
+    assert "p.embedding_next_version" in sql
+    assert "ORDER BY p.id" in sql
+
+
+def test_upsert_sql_rejects_unknown_table():
+    with pytest.raises(ValueError):
+        _upsert_neighbors_sql("embedding", "posts")
+
+
+class _FakeGraph:
+    """conn() stand-in that logs statements per transaction."""
+
+    def __init__(self):
+        self.txns = []
+
+    def __call__(self):
+        self.txns.append([])
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self, *args, **kwargs):
+        return self
+
+    def execute(self, sql, params=None):
+        self.txns[-1].append(" ".join(sql.split()))
+
+    def fetchone(self):
+        return (1, [2, 3], [0.9, 0.8], 1)
+
+    def fetchall(self):
+        return [(2, [4], [0.95]), (3, [1], [0.8])]
+
+
+def test_back_links_are_updated_in_their_own_transaction(monkeypatch):
+    fake = _FakeGraph()
+    monkeypatch.setattr(related, "conn", fake)
+    monkeypatch.setattr(related.psycopg2.extras, "execute_values", lambda cur, sql, rows, template: None)
+
+    related.update_post_neighbors(1)
+
+    own, back = fake.txns
+    assert not any("FOR UPDATE" in sql for sql in own)
+    assert any("INSERT INTO post_neighbors " in sql for sql in own)
+    assert any("ORDER BY post_id FOR UPDATE" in sql for sql in back)